@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Measures lookups through the daemon with one and with two clients.
+
+Serves a phonebook with 10000 entries by a daemon in a background thread
+and connects two clients, which stay connected at the same time. Both must
+get answers, while the other one is connected; otherwise the benchmark
+fails after a few seconds. Then numbers are looked up by one client alone
+and by both clients in parallel threads, and lookups per second are
+printed along with the rate of lookups in the daemon process itself.
+
+Usage: bench_daemon.py [number of entries] [number of lookups]"""
+
+from __future__ import with_statement
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+import random
+import shutil
+import socket
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tel import phonebook, daemon
+
+
+# seconds, which clients wait for answers, before the benchmark fails
+CLIENT_TIMEOUT = 5.0
+BLOCKED_MESSAGE = 'a connected client blocks other clients'
+
+
+def make_phonebook(directory, count):
+    """Creates a phonebook with `count` entries in `directory`, every entry
+    has a national phone number. Returns its uri."""
+    uri = 'csv://' + os.path.join(directory, 'phonebook.csv')
+    book = phonebook.phonebook_open(uri)
+    for i in xrange(count):
+        entry = book.new_entry()
+        entry['firstname'] = u'First%d' % i
+        entry['phone'] = u'(030) %03d-%03d' % divmod(i, 1000)
+        book.add(entry)
+    book.save()
+    return uri
+
+
+def lookup_all(client, numbers):
+    """Looks up all `numbers` with `client`"""
+    for number in numbers:
+        assert len(client.lookup_number(number)) == 1
+
+
+def measure_parallel(clients, numbers):
+    """Looks up `numbers` split among `clients`, every client in its own
+    thread. Returns the elapsed time."""
+    threads = []
+    errors = []
+    for pos, client in enumerate(clients):
+        def run(client=client, part=numbers[pos::len(clients)]):
+            try:
+                lookup_all(client, part)
+            except Exception, exc:
+                errors.append(exc)
+        thread = threading.Thread(target=run)
+        threads.append(thread)
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+def main():
+    count = (int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
+    lookups = (int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    directory = tempfile.mkdtemp()
+    # sockets are created in the user directory
+    os.environ['HOME'] = directory
+    os.environ['TEL_COUNTRY_CODE'] = '49'
+    daemon.TIMEOUT = CLIENT_TIMEOUT
+    server = thread = None
+    clients = []
+    try:
+        uri = make_phonebook(directory, count)
+        server = daemon.LookupDaemon(uri)
+        server.bind()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        numbers = [u'+49 30 %06d' % random.randrange(count)
+                   for i in xrange(lookups)]
+
+        # both clients stay connected, while they send requests in turns
+        # connect answers None, if the daemon doesn't answer
+        clients = [daemon.connect(phonebook.URI(uri)) for i in xrange(2)]
+        if None in clients:
+            sys.exit(BLOCKED_MESSAGE)
+        first, second = clients
+        for client in clients:
+            client.create_number_index(u'49')
+        try:
+            for client in (first, second, first, second):
+                lookup_all(client, numbers[:10])
+        except socket.timeout:
+            sys.exit(BLOCKED_MESSAGE)
+
+        start = time.time()
+        lookup_all(server.phonebook, numbers)
+        in_process = time.time() - start
+        single = measure_parallel([first], numbers)
+        parallel = measure_parallel(clients, numbers)
+
+        print 'lookup %d numbers in %d entries' % (lookups, count)
+        print 'in the daemon process: %10.0f lookups/s' % (lookups /
+                                                            in_process)
+        print 'one client:            %10.0f lookups/s' % (lookups / single)
+        print 'two clients:           %10.0f lookups/s' % (lookups /
+                                                            parallel)
+    finally:
+        # the daemon serves open connections until they are closed
+        for client in clients:
+            if client is not None:
+                client.close()
+        if thread is not None:
+            server.shutdown()
+            # the socket is removed, when serve_forever returns
+            thread.join()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
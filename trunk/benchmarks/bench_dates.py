@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark for date parsing
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Measures the ISO 8601 fast path of teltypes.date.
+
+Parses single dates and loads a csv phonebook, in which every entry has a
+birthday, once with the fast path and once with every date going through
+dateutil.
+
+Usage: bench_dates.py [number of entries]"""
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+import timeit
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tel import phonebook, teltypes
+
+
+class _NeverMatches(object):
+    """Replaces date.iso_pattern to disable the fast path"""
+    def match(self, value):
+        return None
+
+
+def write_phonebook(uri, count):
+    """Writes a phonebook with `count` entries to `uri`"""
+    book = phonebook.phonebook_open(uri)
+    for i in xrange(count):
+        entry = book.new_entry()
+        entry['firstname'] = u'First%d' % i
+        entry['lastname'] = u'Last%d' % i
+        entry['birthday'] = teltypes.date(1950 + i % 50, 1 + i % 12,
+                                          1 + i % 28)
+        book.add(entry)
+    book.save()
+
+
+def time_load(uri):
+    """Returns the seconds needed to load `uri`"""
+    book = phonebook.phonebook_open(uri)
+    start = time.time()
+    book.load()
+    return time.time() - start
+
+
+def main():
+    count = (int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
+    directory = tempfile.mkdtemp()
+    try:
+        uri = 'csv://' + os.path.join(directory, 'birthdays.csv')
+        write_phonebook(uri, count)
+        timer = timeit.Timer('date(u"1980-05-17")',
+                             'from tel.teltypes import date')
+        fast_single = min(timer.repeat(3, 10000)) / 10000
+        fast_load = time_load(uri)
+        teltypes.date.iso_pattern = _NeverMatches()
+        slow_single = min(timer.repeat(3, 10000)) / 10000
+        slow_load = time_load(uri)
+    finally:
+        shutil.rmtree(directory)
+    print 'single date:     %8.2f us (dateutil: %8.2f us)' % (
+        fast_single * 1e6, slow_single * 1e6)
+    print 'load %6d rows: %8.3f s  (dateutil: %8.3f s)' % (
+        count, fast_load, slow_load)
+
+
+if __name__ == '__main__':
+    main()
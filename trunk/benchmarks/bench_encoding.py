@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark for the detection of the locale encoding
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Measures the detection of the locale encoding in encodinghelper.
+
+Compares the former implementation, which asked the 'locale' command in a
+subprocess, with the in-process detection of _locale_encoding, with and
+without the memoised result.
+
+Usage: bench_encoding.py [number of calls]"""
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tel import encodinghelper
+
+
+def read_locale():
+    """The former implementation: asks the 'locale' command"""
+    process = subprocess.Popen(['locale'], stdout=subprocess.PIPE)
+    process.wait()
+    for line in process.stdout:
+        line = line.strip()
+        if line.startswith('LC_MESSAGES'):
+            return line.split('=')[1]
+
+
+def uncached():
+    """Calls _locale_encoding without the memoised result"""
+    encodinghelper._locale_encoding_cache = None
+    return encodinghelper._locale_encoding()
+
+
+def measure(function, calls):
+    """Returns the time per call of `function` in milliseconds"""
+    start = time.time()
+    for i in xrange(calls):
+        function()
+    return (time.time() - start) * 1000 / calls
+
+
+def main():
+    calls = (int(sys.argv[1]) if len(sys.argv) > 1 else 200)
+    print 'detected encoding: %s' % uncached()
+    print 'locale subprocess:       %10.4f ms' % measure(read_locale, calls)
+    print 'in process:              %10.4f ms' % measure(uncached, calls)
+    print 'in process, memoised:    %10.4f ms' % measure(
+        encodinghelper._locale_encoding, calls)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# memory benchmark for entry classes
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Compares the resident memory of phonebook.Entry and
+phonebook.CompactEntry.
+
+Every entry class is measured in a child process, which creates the
+requested number of entries with a few filled fields and reports the growth
+of its maximum resident set size.
+
+Usage: bench_entry_memory.py [number of entries]"""
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+CLASSES = ('Entry', 'CompactEntry')
+
+
+def max_rss():
+    """Returns the maximum resident set size of this process in kB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(class_name, count):
+    """Creates `count` entries of `class_name` and prints the used memory
+    in kB"""
+    from tel import phonebook
+    entry_class = getattr(phonebook, class_name)
+    before = max_rss()
+    entries = []
+    for i in xrange(count):
+        entry = entry_class()
+        entry['firstname'] = u'First%d' % i
+        entry['lastname'] = u'Last%d' % i
+        entry['town'] = u'Berlin'
+        entries.append(entry)
+    print max_rss() - before
+
+
+def main():
+    if len(sys.argv) == 3:
+        measure(sys.argv[1], int(sys.argv[2]))
+        return
+    count = (int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    print '%d entries' % count
+    results = {}
+    for class_name in CLASSES:
+        child = subprocess.Popen([sys.executable, __file__, class_name,
+                                  str(count)], stdout=subprocess.PIPE)
+        results[class_name] = int(child.communicate()[0])
+    for class_name in CLASSES:
+        kbytes = results[class_name]
+        print '%-14s %10d kB %8.1f bytes/entry' % (
+            class_name, kbytes, kbytes * 1024.0 / count)
+
+
+if __name__ == '__main__':
+    main()
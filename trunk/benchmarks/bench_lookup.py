@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark for reverse lookups of phone numbers
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Measures Phonebook.lookup_number with and without number index.
+
+Looks up random numbers, written in another format than stored, in a
+phonebook with 100000 entries. Prints the time to build the index and the
+lookups per second with the index and by scanning all entries.
+
+Usage: bench_lookup.py [number of entries] [number of lookups]"""
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tel import phonebook
+
+
+def make_phonebook(count):
+    """Returns a phonebook with `count` entries, every entry has a national
+    phone and mobile number"""
+    book = phonebook.phonebook_open('csv://benchmark.csv')
+    for i in xrange(count):
+        entry = book.new_entry()
+        entry['firstname'] = u'First%d' % i
+        entry['phone'] = u'(030) %03d-%03d' % divmod(i, 1000)
+        entry['mobile'] = u'0171 %07d' % i
+        book.add(entry)
+    return book
+
+
+def main():
+    count = (int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    lookups = (int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    book = make_phonebook(count)
+    # incoming calls in international format
+    numbers = [u'+49 30 %06d' % random.randrange(count)
+               for i in xrange(lookups)]
+
+    start = time.time()
+    book.create_number_index(u'49')
+    build = time.time() - start
+    start = time.time()
+    found = sum(len(book.lookup_number(number)) for number in numbers)
+    indexed = time.time() - start
+    assert found == lookups
+
+    book.drop_number_index()
+    sample = 5
+    start = time.time()
+    for number in numbers[:sample]:
+        book.lookup_number(number, u'49')
+    scanned = (time.time() - start) / sample
+
+    print 'lookup %d numbers in %d entries' % (lookups, count)
+    print 'building the index: %10.3f s' % build
+    print 'with index:         %10.0f lookups/s' % (lookups / indexed)
+    print 'scanning:           %10.1f lookups/s (%d lookups)' % (
+        1 / scanned, sample)
+
+
+if __name__ == '__main__':
+    main()
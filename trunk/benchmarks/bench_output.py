@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark for the output of entry lists and tables
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+"""Measures the throughput of the output of --list and --table.
+
+Prints 100000 entries with print_short_list and print_entries_table to
+/dev/null. For comparison the same lines are written one at a time
+through the codecs stream writer in encodinghelper, as --list and --table
+did before. Every measurement is repeated three times, the best time is
+printed.
+
+Usage: bench_output.py [number of entries]"""
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tel import phonebook, encodinghelper, cmdline
+
+
+# number of runs of every measurement
+REPEAT = 3
+
+
+def make_phonebook(count):
+    """Returns a phonebook with `count` entries"""
+    book = phonebook.phonebook_open('csv://benchmark.csv')
+    for i in xrange(count):
+        entry = book.new_entry()
+        entry['firstname'] = u'J\xfcrgen%d' % i
+        entry['lastname'] = u'Last%d' % (i % 1000)
+        entry['town'] = u'M\xfcnchen'
+        book.add(entry)
+    return book
+
+
+def list_per_line(entries):
+    """Writes every line of --list through the codecs stream writer"""
+    for entry in entries:
+        encodinghelper.stdout.write(u'%s\n' % entry)
+
+
+def table_per_line(entries, fields):
+    """Writes every line of --table through the codecs stream writer"""
+    rows = [[unicode(entry[field]) for field in fields]
+            for entry in entries]
+    column_widths = map(len, map(phonebook.translate_field, fields))
+    for row in rows:
+        column_widths = map(max, map(len, row), column_widths)
+    for row in rows:
+        row = itertools.imap(unicode.ljust, row, column_widths)
+        encodinghelper.stdout.write(u'| %s |\n' % u' | '.join(row))
+
+
+def measure(function, *args):
+    """Returns the best time needed for function(*args) out of REPEAT
+    runs"""
+    timings = []
+    for i in xrange(REPEAT):
+        start = time.time()
+        function(*args)
+        sys.stdout.flush()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    count = (int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    entries = list(make_phonebook(count))
+    fields = phonebook.FIELDS
+    # redirect standard output, the results are printed to stderr
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    saved_stdout = os.dup(1)
+    os.dup2(devnull, 1)
+    try:
+        timings = [
+            ('--list, per line', measure(list_per_line, entries)),
+            ('--list, buffered', measure(cmdline.print_short_list,
+                                         entries)),
+            ('--table, per line', measure(table_per_line, entries, fields)),
+            ('--table, buffered', measure(cmdline.print_entries_table,
+                                          entries, fields)),
+            ]
+    finally:
+        os.dup2(saved_stdout, 1)
+    print >> sys.stderr, '%d entries, encoding %s' % (
+        count, encodinghelper.stdout_encoding)
+    for name, elapsed in timings:
+        print >> sys.stderr, '%-20s %8.3f s %10d entries/s' % (
+            name, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+    main()
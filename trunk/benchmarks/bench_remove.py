@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark for removing entries
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Measures Phonebook.remove and Phonebook.__contains__.
+
+Removes every 20th entry from a phonebook with 200000 entries. For
+comparison a few removals are also done with list.remove, which compares
+entries by equality, and extrapolated to the same number of removals.
+
+Usage: bench_remove.py [number of entries] [number of removals]"""
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tel import phonebook
+
+
+def make_phonebook(count):
+    """Returns a phonebook with `count` entries"""
+    book = phonebook.phonebook_open('csv://benchmark.csv')
+    for i in xrange(count):
+        entry = book.new_entry()
+        entry['firstname'] = u'First%d' % i
+        entry['lastname'] = u'Last%d' % (i % 1000)
+        book.add(entry)
+    return book
+
+
+def main():
+    count = (int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    removals = (int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    book = make_phonebook(count)
+    victims = list(book)[::count // removals][:removals]
+
+    start = time.time()
+    found = sum(1 for entry in victims if entry in book)
+    for entry in victims:
+        book.remove(entry)
+    elapsed = time.time() - start
+    assert found == removals and len(list(book)) == count - removals
+
+    # list.remove compares by equality, so measure only a few removals
+    sample = 20
+    entries = list(make_phonebook(count))
+    sample_victims = entries[::count // removals][:removals]
+    sample_victims = sample_victims[-sample:]
+    start = time.time()
+    for entry in sample_victims:
+        entries.remove(entry)
+    list_elapsed = (time.time() - start) * removals / sample
+
+    print 'remove %d of %d entries' % (removals, count)
+    print 'Phonebook.remove: %10.3f s' % elapsed
+    print 'list.remove:      %10.3f s (extrapolated from %d removals)' % (
+        list_elapsed, sample)
+
+
+if __name__ == '__main__':
+    main()
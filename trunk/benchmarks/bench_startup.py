@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmark for the startup time of the command line interface
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Measures the cold start latency of every command of the command line
+interface.
+
+Every command is run several times in a fresh interpreter against a
+phonebook with 1000 entries. The median wall clock time is printed along
+with the time spent importing modules. The interpreter startup itself
+("python -c pass") is printed for reference.
+
+With -v the imports of every command are printed as a tree similar to the
+output of "python -X importtime": self and cumulative time in microseconds
+and the name of the imported module.
+
+With --budget the benchmark fails, if the median time of any command
+exceeds the given number of milliseconds.
+
+Usage: bench_startup.py [-v] [--budget ms] [runs] [number of entries]"""
+
+from __future__ import with_statement
+
+__revision__ = '$Id$'
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+PACKAGE_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                 os.pardir))
+sys.path.insert(0, PACKAGE_DIRECTORY)
+
+
+# the command line arguments of each command. Patterns don't match any
+# entry, so that interactive commands don't ask questions.
+COMMANDS = [
+    ('help_fields', ['--help-fields']),
+    ('help_backends', ['--help-backends']),
+    ('list', ['--list']),
+    ('table', ['--table']),
+    ('show', ['--show']),
+    ('create', ['--create']),
+    ('edit', ['--edit', 'no such entry']),
+    ('remove', ['--remove', 'no such entry']),
+    ]
+
+
+def install_import_timer(records):
+    """Replaces __import__ with a function, which appends a tuple
+    (depth, self time, cumulative time, name) to `records` for every
+    import, that loaded new modules."""
+    import __builtin__
+    original_import = __builtin__.__import__
+    # time spent in nested imports for every active import
+    nested = []
+
+    def timed_import(name, *args):
+        fromlist = (args[2] if len(args) > 2 else None)
+        modules = len(sys.modules)
+        nested.append(0.0)
+        depth = len(nested)
+        index = len(records)
+        start = time.time()
+        try:
+            return original_import(name, *args)
+        finally:
+            elapsed = time.time() - start
+            inner = nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            if len(sys.modules) > modules:
+                # nested imports are recorded first, keep the tree order
+                if fromlist and fromlist != ('*',):
+                    name = '%s (%s)' % (name, ', '.join(fromlist))
+                records.insert(index, (depth, elapsed - inner, elapsed,
+                                       name))
+    __builtin__.__import__ = timed_import
+
+
+def run_child(report, args):
+    """Runs tel with `args` and writes the import records to `report`"""
+    records = []
+    install_import_timer(records)
+    sys.argv = ['tel'] + args
+    try:
+        from tel.cmdline import ConsoleIFace
+        ConsoleIFace().start()
+    except SystemExit:
+        pass
+    with open(report, 'w') as stream:
+        for record in records:
+            print >> stream, '%d %f %f %s' % record
+
+
+def make_phonebook(directory, count):
+    """Creates a phonebook with `count` entries in `directory` and returns
+    its uri"""
+    from tel import phonebook
+    uri = 'csv://' + os.path.join(directory, 'phonebook.csv')
+    book = phonebook.phonebook_open(uri)
+    for i in xrange(count):
+        entry = book.new_entry()
+        entry['firstname'] = u'First%d' % i
+        entry['lastname'] = u'Last%d' % (i % 100)
+        entry['birthday'] = u'1980-01-%02d' % (i % 28 + 1)
+        book.add(entry)
+    book.save()
+    return uri
+
+
+def measure(argv, env, runs):
+    """Runs `argv` `runs` times. Returns the median wall clock time."""
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in xrange(runs):
+            start = time.time()
+            process = subprocess.Popen(argv, env=env, stdin=subprocess.PIPE,
+                                       stdout=devnull, stderr=devnull)
+            # enough empty lines to decline every question of --create
+            process.communicate('\n' * 50)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def read_report(report):
+    """Reads import records written by run_child"""
+    records = []
+    with open(report) as stream:
+        for line in stream:
+            depth, selftime, cumulative, name = line.rstrip('\n').split(' ', 3)
+            records.append((int(depth), float(selftime), float(cumulative),
+                            name))
+    return records
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ['--child']:
+        run_child(args[1], args[2:])
+        return
+    verbose = '-v' in args
+    args = [arg for arg in args if arg != '-v']
+    budget = None
+    if '--budget' in args:
+        index = args.index('--budget')
+        budget = float(args[index+1]) / 1000
+        del args[index:index+2]
+    runs = (int(args[0]) if args else 11)
+    count = (int(args[1]) if len(args) > 1 else 1000)
+
+    directory = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ, HOME=directory,
+                   PYTHONPATH=PACKAGE_DIRECTORY)
+        os.environ['HOME'] = directory
+        uri = make_phonebook(directory, count)
+        report = os.path.join(directory, 'imports')
+        over_budget = []
+        baseline = measure([sys.executable, '-c', 'pass'], env, runs)
+        print 'interpreter startup: %8.1f ms' % (baseline * 1000)
+        print '%-15s %10s %10s %8s' % ('command', 'wall (ms)', 'imports',
+                                      'modules')
+        for name, command_args in COMMANDS:
+            argv = ([sys.executable, os.path.abspath(__file__), '--child',
+                     report, '-u', uri] + command_args)
+            elapsed = measure(argv, env, runs)
+            if budget is not None and elapsed > budget:
+                over_budget.append(name)
+            records = read_report(report)
+            imports = sum(record[1] for record in records)
+            print '%-15s %10.1f %8.1f ms %8d' % (name, elapsed * 1000,
+                                                 imports * 1000,
+                                                 len(records))
+            if verbose:
+                for depth, selftime, cumulative, module in records:
+                    print '    %8d | %8d | %s%s' % (
+                        selftime * 1e6, cumulative * 1e6, '  ' * depth,
+                        module)
+    finally:
+        shutil.rmtree(directory)
+    if over_budget:
+        sys.exit('over budget: %s' % ', '.join(over_budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -60,7 +60,7 @@ setup(name='tel',
       # list packages
       packages=['tel'],
       package_dir={'': 'src'},
-      package_data={'tel': ['backends/*.py']},
+      package_data={'tel': ['backends/*.py', 'backends/*.manifest']},
       # scripts
       scripts=[('src/tel_console.py', 'tel')],
       # i18n
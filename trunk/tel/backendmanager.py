@@ -29,8 +29,10 @@ __revision__ = '$Id$'
 
 import os
 import imp
-from itertools import ifilter
+import stat
+import marshal
 from UserDict import DictMixin
+from ConfigParser import RawConfigParser, Error as ConfigParserError
 
 from tel import config
 
@@ -41,6 +43,12 @@ _ = config.translation.ugettext
 MODULE_SUFFIXES = zip(*imp.get_suffixes())[0]
 # this is the pattern used to expand a backend name
 BACKEND_MODULE_PATTERN = u'%s_backend'
+# name of the file in the user directory, which caches the contents of
+# backend directories
+REGISTRY_FILENAME = 'backends.cache'
+# suffix of backend manifests. The manifest of the backend "foo" is
+# foo_backend.manifest in the directory of the backend module.
+MANIFEST_SUFFIX = '.manifest'
 
 
 def get_backend_name(filename):
@@ -72,31 +80,114 @@ class BackendError(ImportError):
                     'exception': exception.__class__.__name__,
                     'message': exception.message}
             super(ImportError, self).__init__(msg % args)
-            else:
-        super(ImportError, self).__init__(_(u'Invalid backend %s in %s')
-                                          % {'backend': backend,
-                                             'filename': filename})
+        else:
+            msg = _(u'Invalid backend %(backend)s in %(filename)s')
+            super(ImportError, self).__init__(msg % {'backend': backend,
+                                                     'filename': filename})
+
+
+def read_manifest(path):
+    """Reads the backend manifest `path`, which looks like this:
+
+        [backend]
+        extensions = .csv .txt
+        schemes = csv
+
+    extensions are the file extensions supported by the backend, schemes
+    are uri schemes, which select the backend in addition to its name.
+    Both are lists separated by whitespace or commas.
+
+    :returns: A dictionary with the keys 'extensions' and 'schemes'
+    :raises EnvironmentError: If `path` can't be read
+    :raises ConfigParser.Error: If `path` is no valid manifest"""
+    parser = RawConfigParser()
+    with open(path) as stream:
+        parser.readfp(stream, path)
+    manifest = {}
+    for key in ('extensions', 'schemes'):
+        value = (parser.get('backend', key) if
+                 parser.has_option('backend', key) else '')
+        manifest[key] = value.replace(',', ' ').lower().split()
+    return manifest
 
 
 class BackendManager(DictMixin):
     """Responsible for loading backends.
     Backends don't need to be loaded explicitly. Just use the provided
     dictionary interface to access backends by name. Loading will happen
-    automatically."""
+    automatically.
+
+    Backends may declare supported file extensions and uri schemes in a
+    manifest (see read_manifest). Such backends are not imported to find
+    a backend for a file."""
 
     def __init__(self):
         """Creates a new backend manager."""
         self._loaded_cache = {}
+        # maps backend directories to a tuple containing the modification
+        # time of the directory and the backends found in it
+        self._registry = None
+        # maps backend names to their manifests
+        self._manifests = {}
+
+    def _registry_path(self):
+        """Returns the path of the persistent backend registry"""
+        return os.path.join(config.user_directory, REGISTRY_FILENAME)
+
+    def _read_registry(self):
+        """Reads the persistent backend registry. Returns an empty
+        registry, if it doesn't exist or is invalid"""
+        try:
+            with open(self._registry_path(), 'rb') as stream:
+                registry = marshal.load(stream)
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return {}
+        return (registry if isinstance(registry, dict) else {})
+
+    def _write_registry(self):
+        """Writes the persistent backend registry. Errors are ignored, the
+        registry is just a cache."""
+        path = self._registry_path()
+        tmpname = '%s.%d' % (path, os.getpid())
+        try:
+            with open(tmpname, 'wb') as stream:
+                marshal.dump(self._registry, stream)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmpname, path)
+        except EnvironmentError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
 
     def _find_backends(self):
-        """Finds all backends"""
+        """Finds all backends.
+
+        The backends found in a directory are cached in memory and in the
+        persistent registry. A directory is only listed again, if its
+        modification time changed."""
+        if self._registry is None:
+            self._registry = self._read_registry()
         backends = []
-        for path in ifilter(os.path.isdir, config.backend_directories):
-            files = os.listdir(path)
-            for fso in files:
-                mod_name = get_backend_name(fso)
-                if mod_name and mod_name not in backends:
+        changed = False
+        for path in config.backend_directories:
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(status.st_mode):
+                continue
+            cached = self._registry.get(path)
+            if cached is None or cached[0] != status.st_mtime:
+                names = filter(None, map(get_backend_name, os.listdir(path)))
+                self._registry[path] = (status.st_mtime, names)
+                changed = True
+            else:
+                names = cached[1]
+            for mod_name in names:
+                if mod_name not in backends:
                     backends.append(mod_name)
+        if changed:
+            self._write_registry()
         return backends
 
     def _load_backend(self, backend, force=False):
@@ -112,7 +203,7 @@ class BackendManager(DictMixin):
                     # handle exception during loading
                     raise BackendError(backend, desc[1], ex)
             if not self._check_module(module):
-                raise BackendErrot(backend, desc[1])
+                raise BackendError(backend, desc[1])
             else:
                 self._loaded_cache[backend] = module
                 # set the module name
@@ -120,6 +211,37 @@ class BackendManager(DictMixin):
                 return module
         return self._loaded_cache[backend]
 
+    def manifest(self, backend):
+        """Returns the manifest of `backend` as returned by read_manifest,
+        or None, if `backend` has no valid manifest"""
+        if backend not in self._manifests:
+            manifest = None
+            for path in config.backend_directories:
+                cached = self._registry and self._registry.get(path)
+                if cached and backend in cached[1]:
+                    filename = os.path.join(path, (BACKEND_MODULE_PATTERN %
+                                                   backend) + MANIFEST_SUFFIX)
+                    try:
+                        manifest = read_manifest(filename)
+                    except (EnvironmentError, ConfigParserError):
+                        pass
+                    break
+            self._manifests[backend] = manifest
+        return self._manifests[backend]
+
+    def backend_for_scheme(self, scheme):
+        """Returns the name of the backend for the uri `scheme`, which is
+        either the backend name itself or a scheme declared in a manifest.
+        Returns None, if there is no such backend."""
+        backends = self._find_backends()
+        if scheme in backends:
+            return scheme
+        for backend in backends:
+            manifest = self.manifest(backend)
+            if manifest and scheme.lower() in manifest['schemes']:
+                return backend
+        return None
+
     def _check_module(self, module):
         """Checks `module`. Returns False, if `module` is not valid
         backend"""
@@ -128,7 +250,8 @@ class BackendManager(DictMixin):
     def __getitem__(self, name):
         try:
             return self._load_backend(name)
-        except BackendError:
+        except ImportError:
+            # BackendError or module not found
             raise KeyError(_(u'No backend "%s" found.') % name)
 
     def __iter__(self):
@@ -152,13 +275,29 @@ class BackendManager(DictMixin):
                 continue
 
     def backend_for_file(self, filename):
-        """Returns a backend, which supports `filename`"""
+        """Returns a backend, which supports `filename`.
+
+        Backends with a manifest are selected by the extension of
+        `filename` without importing them. Other backends are imported
+        and asked through their supports function."""
+        extension = os.path.splitext(filename)[1].lower()
+        undeclared = []
         for backend in self:
+            manifest = self.manifest(backend)
+            if manifest is None:
+                undeclared.append(backend)
+            elif extension in manifest['extensions']:
+                try:
+                    return self[backend]
+                except KeyError:
+                    # backend is broken
+                    continue
+        for backend in undeclared:
             try:
                 if self[backend].supports(filename):
                     return self[backend]
-            except AttributeError:
-                # backend doesn't define "support"
+            except (KeyError, AttributeError):
+                # backend is broken or doesn't define "supports"
                 pass
         return None
 
@@ -29,9 +29,14 @@ __revision__ = '$Id$'
 
 import os
 import csv
+import stat
 import errno
+import locale
+import marshal
+import hashlib
+import tempfile
 
-from tel.phonebook import Entry, Phonebook
+from tel.phonebook import CompactEntry, Phonebook, FIELDS
 from tel import config
 from tel import teltypes
 
@@ -47,6 +52,14 @@ applications like Excel or OpenOffice.org Calc.
 __short_description__ = _('A csv-based backend')
 
 
+# name of the column storing entry ids
+ID_COLUMN = 'id'
+# suffix of the file storing persistent sort indexes of a phonebook file
+SORT_INDEX_SUFFIX = 'sortidx'
+# suffix of the file caching the parsed contents of a phonebook file
+CACHE_SUFFIX = 'cache'
+
+
 # Modules, that don't define this function are never loaded for
 # non-absolute uris
 def supports(path):
@@ -57,46 +70,270 @@ def supports(path):
 
 
 class CsvPhonebook(Phonebook):
+    """Phonebook stored in a csv file.
+
+    The parsed contents of the csv file and persistent sort indexes are
+    stored in hidden files next to the csv file (see _sidecar_path).
+    These are only used, if the csv file wasn't changed since, otherwise
+    the csv file is parsed again."""
+
+    entry_class = CompactEntry
 
     def __init__(self, uri):
         Phonebook.__init__(self, uri)
         self.uri.location = os.path.expanduser(self.uri.location)
+        # size and modification time of the file after the last load or
+        # save, None if there was no file
+        self._stat = None
+        # column names of the file after the last load or save
+        self._header = None
 
-    def load(self):
-        """Load entries."""
+    def load(self, lazy=False, lazy_types=False):
+        """Load entries. If `lazy` is True, rows are parsed not until
+        entries are accessed. If `lazy_types` is True, values are
+        converted not until they are read."""
         self.clear()
+        self._mark_clean()
+        self._stat = None
+        self._header = None
         try:
-            with open(self.uri.location, 'rb') as stream:
-                self.reader = csv.DictReader(stream)
-                for row in self.reader:
-                    entry = Entry()
-                    for k in row:
-                        val = row[k].decode('utf-8')
-                        try:
-                            entry[k] = val
-                        except KeyError:
-                            # ignore invalid fields
-                            pass
-                    self.add(entry)
+            stream = open(self.uri.location, 'rb')
         except IOError, exc:
             # no file, nothing to read, but no reason for an error
             if exc.errno != errno.ENOENT:
                 raise
+            return
+        self._stat = self._file_stat(os.fstat(stream.fileno()))
+        cached = self._read_sidecar(CACHE_SUFFIX)
+        if cached is not None and cached[0] == FIELDS:
+            stream.close()
+            entries = self._load_cache(cached, lazy_types)
+        else:
+            entries = self._parse(stream, lazy_types)
+        if lazy:
+            self._load_lazily(entries)
+        else:
+            for entry in entries:
+                self._append(entry)
+
+    def _parse(self, stream, lazy_types=False):
+        """Generates entries from the rows of `stream`. `stream` is closed
+        after the last row. Then the parsed rows are cached."""
+        rows = []
+        with stream:
+            reader = csv.DictReader(stream)
+            for row in reader:
+                entry = self.new_entry()
+                entry_id = (row.pop(ID_COLUMN, None) or
+                            self._legacy_id(reader.line_num, row))
+                entry.id = entry_id.decode('utf-8')
+                for k in row:
+                    val = row[k].decode('utf-8')
+                    try:
+                        entry.set_raw(k, val)
+                    except KeyError:
+                        # ignore invalid fields
+                        pass
+                rows.append((entry.id,) + entry.raw_values())
+                if not lazy_types:
+                    entry.convert()
+                yield entry
+            self._header = reader.fieldnames
+        self._write_sidecar(CACHE_SUFFIX, (FIELDS, self._header, rows))
+
+    def _load_cache(self, cached, lazy_types=False):
+        """Generates entries from the `cached` rows written by _parse"""
+        fields, self._header, rows = cached
+        from_raw = self.entry_class.from_raw
+        for (entry_id, values, raw) in rows:
+            entry = from_raw(values, raw)
+            entry.id = entry_id
+            if not lazy_types:
+                entry.convert()
+            yield entry
+
+    @staticmethod
+    def _legacy_id(line, row):
+        """Derives an id for a `row` without id from the row contents and
+        the `line` number, so that it is stable until the file is saved"""
+        digest = hashlib.md5(str(line))
+        for key in sorted(row):
+            digest.update('\0%s=%s' % (key, row[key]))
+        return digest.hexdigest()
+
+    def _columns(self):
+        """Returns the list of column names"""
+        return list(self.supported_fields()) + [ID_COLUMN]
 
     def save(self):
-        """Save entries."""
-        with open(self.uri.location, 'wb') as stream:
-            # write field name header
-            csv.writer(stream).writerow(self.supported_fields())
-            writer = csv.DictWriter(stream, self.supported_fields())
-            for entry in self:
-                row = {}
-                for k, v in entry.iteritems():
-                    # write date values in international format
-                    if isinstance(v, teltypes.date):
-                        v = v.isoformat()
-                    row[k] = v.encode('utf-8')
-                writer.writerow(row)
+        """Save entries.
+
+        Nothing is written, if there are no changes. If entries were only
+        added, and the file was not changed by others in the meantime, the
+        new entries are appended to the file. Otherwise the whole file is
+        written to a temporary file, which then replaces the old file."""
+        if self._defer_save() or not self.is_modified():
+            return
+        added = self.added_entries()
+        if added is not None and self._header == self._columns() and \
+               self._stat is not None and \
+               self._stat == self._current_stat():
+            with open(self.uri.location, 'r+b') as stream:
+                stream.seek(-1, os.SEEK_END)
+                last = stream.read(1)
+                # switching from reading to writing requires a seek
+                stream.seek(0, os.SEEK_END)
+                if last not in '\r\n':
+                    # a hand-edited file may lack the final line break
+                    stream.write('\r\n')
+                self._write_rows(stream, added)
+                stream.flush()
+                os.fsync(stream.fileno())
+        else:
+            self._materialize()
+            self._replace_file()
+        self._stat = self._current_stat()
+        self._header = self._columns()
+        self._mark_clean()
+        self._store_sort_indexes()
+
+    def _sidecar_path(self, suffix):
+        """Returns the path of the hidden file with `suffix`, which stores
+        additional data next to the phonebook file"""
+        directory, name = os.path.split(os.path.realpath(self.uri.location))
+        return os.path.join(directory, '.%s.%s' % (name, suffix))
+
+    def _read_sidecar(self, suffix):
+        """Reads the data stored by _write_sidecar in the file with
+        `suffix`. Returns None, if the file doesn't exist, is invalid or
+        was written for another version of the phonebook file. Files with
+        other permissions than the phonebook file are ignored too, so that
+        they are written again with the right permissions."""
+        if self._stat is None:
+            return None
+        try:
+            mode = stat.S_IMODE(os.stat(self.uri.location).st_mode)
+            with open(self._sidecar_path(suffix), 'rb') as stream:
+                if stat.S_IMODE(os.fstat(stream.fileno()).st_mode) != mode:
+                    return None
+                stored = marshal.load(stream)
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(stored, tuple) or len(stored) != 2 or \
+               stored[0] != self._stat:
+            return None
+        return stored[1]
+
+    def _write_sidecar(self, suffix, data):
+        """Stores `data` in the file with `suffix` along with size and
+        modification time of the phonebook file. `data` must be
+        serializable by marshal. Sidecar files contain the same data as
+        the phonebook file, so they get its permissions. Errors are
+        ignored, sidecar files only save time."""
+        if self._stat is None:
+            return
+        path = self._sidecar_path(suffix)
+        directory, name = os.path.split(path)
+        try:
+            mode = stat.S_IMODE(os.stat(self.uri.location).st_mode)
+            # the temporary file is only readable by the user, until it
+            # gets the permissions of the phonebook
+            handle, tmpname = tempfile.mkstemp(prefix='%s.' % name,
+                                               dir=directory)
+        except EnvironmentError:
+            return
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                marshal.dump((self._stat, data), stream)
+            os.chmod(tmpname, mode)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmpname, path)
+        except EnvironmentError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def _sort_key_locale(self):
+        """Returns the locale, which affects sort keys. Dates are converted
+        to strings according to the locale."""
+        return locale.setlocale(locale.LC_TIME)
+
+    def _stored_sort_index(self, field, ignore_case):
+        stored = self._read_sidecar(SORT_INDEX_SUFFIX)
+        if stored is None or stored.get('locale') != self._sort_key_locale():
+            return None
+        return stored['indexes'].get((field, ignore_case))
+
+    def _store_sort_indexes(self):
+        indexes = self.persistent_sort_indexes()
+        if not indexes or self.is_modified():
+            # the file doesn't match the phonebook
+            return
+        data = self._read_sidecar(SORT_INDEX_SUFFIX)
+        if data is None or data.get('locale') != self._sort_key_locale():
+            data = {'locale': self._sort_key_locale(), 'indexes': {}}
+        # keep other valid indexes
+        for index in indexes:
+            data['indexes'][(index.field, index.ignore_case)] = (
+                index.keys(), index.entry_ids())
+        self._write_sidecar(SORT_INDEX_SUFFIX, data)
+
+    def _replace_file(self):
+        """Writes all entries to a temporary file in the same directory
+        and renames it to the phonebook file"""
+        # don't replace symbolic links
+        location = os.path.realpath(self.uri.location)
+        directory, name = os.path.split(location)
+        try:
+            mode = stat.S_IMODE(os.stat(location).st_mode)
+        except OSError:
+            # new file, respect umask
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        handle, tmpname = tempfile.mkstemp(prefix='.%s.' % name,
+                                           dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                csv.writer(stream).writerow(self._columns())
+                self._write_rows(stream, self)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.chmod(tmpname, mode)
+            if os.name == 'nt' and os.path.exists(location):
+                # rename doesn't replace existing files on windows
+                os.remove(location)
+            os.rename(tmpname, location)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def _write_rows(self, stream, entries):
+        """Writes a csv row for each of `entries` to `stream`"""
+        writer = csv.DictWriter(stream, self._columns())
+        for entry in entries:
+            row = {ID_COLUMN: entry.id.encode('utf-8')}
+            for k, v in entry.iteritems():
+                # write date values in international format
+                if isinstance(v, teltypes.date):
+                    v = v.isoformat()
+                row[k] = unicode(v).encode('utf-8')
+            writer.writerow(row)
+
+    def _current_stat(self):
+        """Returns size and modification time of the phonebook file, or
+        None, if there is no such file"""
+        try:
+            return self._file_stat(os.stat(self.uri.location))
+        except OSError:
+            return None
+
+    @staticmethod
+    def _file_stat(result):
+        """Extracts the values compared by _current_stat from the
+        os.stat `result`"""
+        return (result.st_size, result.st_mtime)
 
 
 __phonebook_class__ = CsvPhonebook
@@ -53,6 +53,16 @@ class KABCEntry(Entry):
     def __init__(self):
         self.kabc_entry = None
 
+    def _get_id(self):
+        return unicode(self.kabc_entry.uid())
+
+    def _set_id(self, entry_id):
+        # the phonebook assigns new ids to addressees with duplicate uids
+        self.kabc_entry.setUid(entry_id)
+
+    id = property(_get_id, _set_id,
+                  doc="""The unique identifier of the addressee""")
+
     def __setitem__(self, field, value):
         raise NotImplementedError()
 
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+# sqlite backend for tel
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+__revision__ = '$Id$'
+
+
+import os
+import itertools
+
+try:
+    import sqlite3
+except ImportError:
+    # python 2.4
+    from pysqlite2 import dbapi2 as sqlite3
+
+from tel.phonebook import (CompactEntry, Phonebook, FIELDS, NoSuchField,
+                           field_type, _literal_prefix)
+from tel.query import Equals, Prefix, Regex, And, Or
+from tel import config
+from tel import teltypes
+
+
+_ = config.translation.ugettext
+
+
+__long_description__ = _("""\
+A backend, which stores entries in a SQLite database. Searches for
+plain strings and prefixes as well as sorting are done by the database,
+so large phonebooks needn't be loaded completely. Changed entries are
+updated one by one.
+""")
+__short_description__ = _('A SQLite-based backend')
+
+
+# name of the table storing entries
+TABLE = 'entries'
+# fields, which are indexed in the database
+INDEXED_FIELDS = ('firstname', 'lastname', 'nickname', 'town', 'email',
+                  'phone', 'mobile', 'tags')
+# number of rows fetched at once by lazy loading
+FETCH_SIZE = 256
+# seconds to wait for locks held by other processes
+TIMEOUT = 10.0
+
+
+# positions and bits in the raw mask of entries (see Entry.raw_values) of
+# fields, whose stored text must be converted
+_CONVERTED_FIELDS = [(pos, 1 << pos) for (pos, field) in enumerate(FIELDS)
+                     if field_type(field) is not unicode]
+
+
+def supports(path):
+    """Checks, if `path` denotes a valid file for this filetype.
+    :returns: True, if `path` is supported"""
+    ext = os.path.splitext(path)[1]
+    return ext.lower() in ('.sqlite', '.db')
+
+
+def _stored_value(value):
+    """Returns the text stored in the database for `value`"""
+    # write date values in international format
+    if isinstance(value, teltypes.date):
+        return value.isoformat()
+    return unicode(value)
+
+
+def _text_field(field):
+    """Returns True, if the stored text of `field` equals the unicode
+    representation of its values, so that the database can compare and
+    sort it like find_all and sort_by_field do"""
+    return field_type(field) is not teltypes.date
+
+
+def _nocase(text):
+    """Returns True, if the NOCASE collation of SQLite compares `text` like
+    unicode.lower does. NOCASE only folds ASCII letters."""
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def _successor(prefix):
+    """Returns the smallest string greater than all strings starting with
+    `prefix`, or None, if there is no such string"""
+    last = ord(prefix[-1])
+    if last >= 0xffff:
+        return None
+    return prefix[:-1] + unichr(last + 1)
+
+
+class SqliteSortIndex(object):
+    """Sorts entries of a SqlitePhonebook in the database.
+
+    This provides the part of the SortIndex interface used by
+    Phonebook.entries_between. Entries are only created
+    for rows, which are actually fetched."""
+
+    def __init__(self, phonebook, field, ignore_case=False):
+        self.phonebook = phonebook
+        self.field = field
+        self.ignore_case = ignore_case
+
+    def iter_entries(self, descending=False):
+        """Returns an iterator over all entries in sorted order"""
+        return self.range(descending=descending)
+
+    def range(self, low=None, high=None, descending=False):
+        """Returns an iterator over all entries, whose key is not less than
+        `low` and less than `high`, in sorted order"""
+        column = self.phonebook._column(self.field, self.ignore_case)
+        conditions = []
+        params = []
+        if low is not None:
+            conditions.append('%s >= ?' % column)
+            params.append(low.lower() if self.ignore_case else low)
+        if high is not None:
+            conditions.append('%s < ?' % column)
+            params.append(high.lower() if self.ignore_case else high)
+        # like sorted, keep the phonebook order of equal keys
+        order = '%s %s, rowid' % (column, ('DESC' if descending else 'ASC'))
+        return self.phonebook._fetch(' AND '.join(conditions), params, order)
+
+
+class SqlitePhonebook(Phonebook):
+    """Phonebook stored in a SQLite database.
+
+    Every entry is a row of a single table, searchable fields are indexed.
+    If the phonebook has no unsaved changes, queries (see
+    Phonebook.execute), entries_between and by_id are answered by the
+    database and only create entries for the rows found,
+    even if the phonebook was loaded lazily and not iterated yet. These
+    entries are added to the phonebook, so they come first, when a lazily
+    loaded phonebook is iterated. save writes only added, changed and
+    removed entries."""
+
+    entry_class = CompactEntry
+
+    def __init__(self, uri):
+        Phonebook.__init__(self, uri)
+        self.uri.location = os.path.expanduser(self.uri.location)
+        self._connection = None
+        self._lazy_types = False
+        # ids of entries, which are stored in the database
+        self._stored = set()
+        # ids of entries added or changed since the last load or save
+        self._changed = set()
+        # ids of entries removed since the last load or save
+        self._removed = set()
+        # True, if all entries were removed by clear
+        self._cleared = False
+
+    def _connect(self):
+        """Returns the connection to the database, which is opened and
+        initialized on first use"""
+        if self._connection is None:
+            connection = sqlite3.connect(self.uri.location, timeout=TIMEOUT)
+            # python string methods fold case like the in-memory search
+            connection.create_function('fold', 1, lambda v: v.lower())
+            self._create_schema(connection)
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    def _create_schema(connection):
+        """Creates the table and indexes, if they don't exist, and adds
+        columns for new fields"""
+        columns = ', '.join("%s TEXT NOT NULL DEFAULT ''" % field for field
+                            in FIELDS)
+        connection.execute('CREATE TABLE IF NOT EXISTS %s '
+                           '(id TEXT PRIMARY KEY NOT NULL, %s)' %
+                           (TABLE, columns))
+        existing = set(row[1] for row in
+                       connection.execute('PRAGMA table_info(%s)' % TABLE))
+        for field in FIELDS:
+            if field not in existing:
+                connection.execute("ALTER TABLE %s ADD COLUMN %s TEXT NOT "
+                                   "NULL DEFAULT ''" % (TABLE, field))
+        for field in INDEXED_FIELDS:
+            connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                               % (TABLE, field, TABLE, field))
+            # for case-insensitive searches
+            connection.execute('CREATE INDEX IF NOT EXISTS %s_%s_nocase ON '
+                               '%s (%s COLLATE NOCASE)'
+                               % (TABLE, field, TABLE, field))
+        connection.commit()
+
+    def load(self, lazy=False, lazy_types=False):
+        """Load entries. If `lazy` is True, rows are fetched not until
+        entries are accessed. If `lazy_types` is True, values are
+        converted not until they are read."""
+        Phonebook.clear(self)
+        self._mark_clean()
+        self._lazy_types = lazy_types
+        self._stored = set()
+        self._changed = set()
+        self._removed = set()
+        self._cleared = False
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if not os.path.exists(self.uri.location):
+            # no database, nothing to read, but no reason for an error. The
+            # database is created on save.
+            return
+        self._connect()
+        entries = self._iter_rows()
+        if lazy:
+            self._load_lazily(entries)
+        else:
+            for entry in entries:
+                self._append(entry)
+
+    def _iter_rows(self):
+        """Generates entries for all rows, which are not yet contained in
+        this phonebook. Rows are fetched in chunks, so that saving in the
+        meantime doesn't interfere."""
+        query = ('SELECT rowid, id, %s FROM %s WHERE rowid > ? ORDER BY '
+                 'rowid LIMIT %d' % (', '.join(FIELDS), TABLE, FETCH_SIZE))
+        last = -1
+        while True:
+            rows = self._connection.execute(query, (last,)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                # entries may have been fetched by a query already
+                if row[1] not in self._positions and \
+                       row[1] not in self._removed:
+                    yield self._entry_from_row(row[1:])
+            last = rows[-1][0]
+
+    def _entry_from_row(self, row):
+        """Creates an entry from a row of id and field values"""
+        values = row[1:]
+        raw = 0
+        for pos, bit in _CONVERTED_FIELDS:
+            if values[pos] != '':
+                raw |= bit
+        entry = self.entry_class.from_raw(values, raw)
+        entry.id = row[0]
+        if not self._lazy_types:
+            entry.convert()
+        self._stored.add(entry.id)
+        return entry
+
+    def _pushdown(self):
+        """Returns True, if queries can be answered by the database"""
+        return self._connection is not None and not self.is_modified()
+
+    def _column(self, field, ignore_case=False):
+        """Returns the sql expression for `field`"""
+        return ('fold(%s)' % field if ignore_case else field)
+
+    def _fetch(self, condition='', params=(), order='rowid', limit=None):
+        """Returns an iterator over the entries of all rows matching the sql
+        `condition` in `order`, at most `limit` entries. Entries of rows,
+        which are not yet contained in this phonebook, are created and
+        added."""
+        query = 'SELECT id, %s FROM %s' % (', '.join(FIELDS), TABLE)
+        if condition:
+            query += ' WHERE ' + condition
+        query += ' ORDER BY ' + order
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        cursor = self._connection.execute(query, params)
+        for row in cursor:
+            pos = self._positions.get(row[0])
+            if pos is not None:
+                yield self._entries[pos]
+            else:
+                entry = self._entry_from_row(row)
+                self._append(entry)
+                yield entry
+
+    def _execute_query(self, query):
+        """Answers `query` with a sql query, if there are no unsaved
+        changes. Predicates, which can't be expressed in sql, are evaluated
+        on the rows found. Queries sorting by dates are declined."""
+        if not self._pushdown():
+            return None
+        sort = query.sort
+        if sort is not None and not self._sortable(sort.field):
+            return None
+        condition, params, exact = '', [], True
+        if query.where is not None:
+            condition, params, exact = self._condition(query.where)
+        if sort is not None:
+            # like sorted, keep the phonebook order of equal keys
+            order = '%s %s, rowid' % (
+                self._column(sort.field, sort.ignore_case),
+                ('DESC' if sort.descending else 'ASC'))
+        else:
+            order = 'rowid'
+        if exact:
+            return self._fetch(condition, params, order, query.limit)
+        entries = self._fetch(condition, params, order)
+        match = query.where.matcher()
+        matching = (entry for entry in entries if match(entry))
+        if query.limit is not None:
+            return itertools.islice(matching, query.limit)
+        return matching
+
+    @staticmethod
+    def _sortable(field):
+        """Returns True, if the database can compare `field`"""
+        return field in FIELDS and _text_field(field)
+
+    def _condition(self, predicate):
+        """Translates `predicate` into a sql condition. Returns a tuple of
+        the condition, its parameters and a boolean, which is False, if
+        rows matching the condition must still be tested with `predicate`.
+        The condition is None, if the database can't narrow the rows."""
+        if isinstance(predicate, (And, Or)):
+            parts = map(self._condition, predicate.operands)
+            exact = all(part[2] for part in parts)
+            if isinstance(predicate, And):
+                # the database narrows by all parts it understands
+                parts = [part for part in parts if part[0] is not None]
+                operator = ' AND '
+            elif any(part[0] is None for part in parts):
+                return (None, [], False)
+            else:
+                operator = ' OR '
+            if not parts:
+                return (None, [], False)
+            condition = operator.join('(%s)' % part[0] for part in parts)
+            return (condition, sum((part[1] for part in parts), []), exact)
+        if not isinstance(predicate, (Equals, Prefix, Regex)) or \
+               not self._sortable(predicate.field):
+            return (None, [], False)
+        if isinstance(predicate, Equals):
+            value = predicate.value
+            if predicate.ignore_case:
+                value = value.lower()
+            column = self._search_column(predicate.field,
+                                         predicate.ignore_case, value)
+            return ('%s = ?' % column, [value], True)
+        if isinstance(predicate, Prefix):
+            prefix, exact = predicate.prefix, True
+        else:
+            prefix, exact = _literal_prefix(predicate.regex), False
+        if not prefix:
+            return (None, [], False)
+        if predicate.ignore_case:
+            prefix = prefix.lower()
+        successor = _successor(prefix)
+        if successor is None:
+            return (None, [], False)
+        column = self._search_column(predicate.field, predicate.ignore_case,
+                                     prefix)
+        if column.endswith('NOCASE') and successor[-1] == u'A':
+            # NOCASE orders lower case letters after "[", so the successor
+            # of "@" is "["
+            successor = successor[:-1] + u'['
+        return ('%s >= ? AND %s < ?' % (column, column), [prefix, successor],
+                exact)
+
+    def _search_column(self, field, ignore_case, value):
+        """Returns the sql expression for `field`, which is compared with
+        `value`. Case-insensitive comparisons with ASCII values use the
+        NOCASE indexes. Like the in-memory search, comparisons with other
+        values fold case with unicode.lower, but scan all rows."""
+        if ignore_case and _nocase(value):
+            return '%s COLLATE NOCASE' % field
+        return self._column(field, ignore_case)
+
+    def by_id(self, entry_id):
+        """Returns the entry with the id `entry_id`. Entries, which are not
+        yet loaded, are fetched from the database.
+
+        :raises KeyError: If there is no such entry"""
+        if entry_id in self._positions or self._pending is None or \
+               self._connection is None or entry_id in self._removed:
+            return Phonebook.by_id(self, entry_id)
+        for entry in self._fetch('id = ?', (entry_id,)):
+            return entry
+        raise KeyError(entry_id)
+
+    def create_sort_index(self, field, ignore_case=False,
+                          persistent=False):
+        """Entries are sorted by the database, so a sort index is only
+        maintained for fields, which the database can't sort"""
+        if field not in self.supported_fields():
+            raise NoSuchField(field)
+        if not _text_field(field):
+            Phonebook.create_sort_index(self, field, ignore_case)
+
+    def sort_index(self, field, ignore_case=False):
+        """Returns a SqliteSortIndex for `field`, if the database can sort
+        it, otherwise the SortIndex for `field` or None"""
+        if self._sortable(field) and self._pushdown():
+            return SqliteSortIndex(self, field, ignore_case)
+        return Phonebook.sort_index(self, field, ignore_case)
+
+    def _index_entry(self, entry):
+        Phonebook._index_entry(self, entry)
+        if entry.id not in self._stored or entry.id in self._removed:
+            self._removed.discard(entry.id)
+            self._changed.add(entry.id)
+
+    def _unindex_entry(self, entry):
+        Phonebook._unindex_entry(self, entry)
+        self._changed.discard(entry.id)
+        if entry.id in self._stored:
+            self._removed.add(entry.id)
+
+    def _field_changed(self, entry, field, oldvalue):
+        Phonebook._field_changed(self, entry, field, oldvalue)
+        self._changed.add(entry.id)
+
+    def clear(self):
+        """Removes all entries"""
+        Phonebook.clear(self)
+        self._cleared = True
+        self._stored = set()
+        self._changed = set()
+        self._removed = set()
+
+    def save(self):
+        """Save entries.
+
+        Nothing is written, if there are no changes. Otherwise removed
+        entries are deleted, changed entries are updated and added entries
+        are inserted in a single transaction."""
+        if self._defer_save() or not self.is_modified():
+            return
+        connection = self._connect()
+        # insert added entries in phonebook order
+        changed = sorted(self._changed, key=self._positions.get)
+        columns = ', '.join(FIELDS)
+        update = 'UPDATE %s SET %s WHERE id = ?' % (
+            TABLE, ', '.join('%s = ?' % field for field in FIELDS))
+        insert = 'INSERT INTO %s (%s, id) VALUES (%s)' % (
+            TABLE, columns, ', '.join('?' * (len(FIELDS) + 1)))
+        try:
+            cursor = connection.cursor()
+            if self._cleared:
+                cursor.execute('DELETE FROM %s' % TABLE)
+            cursor.executemany('DELETE FROM %s WHERE id = ?' % TABLE,
+                               [(entry_id,) for entry_id in self._removed])
+            for entry_id in changed:
+                entry = self._entries[self._positions[entry_id]]
+                values = [_stored_value(entry[field]) for field in FIELDS]
+                values.append(entry_id)
+                cursor.execute(update, values)
+                if cursor.rowcount < 1:
+                    cursor.execute(insert, values)
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        self._stored.update(changed)
+        self._stored.difference_update(self._removed)
+        self._changed = set()
+        self._removed = set()
+        self._cleared = False
+        self._mark_clean()
+
+
+__phonebook_class__ = SqlitePhonebook
@@ -22,39 +22,39 @@
 
 """This is the command line front end to tel"""
 
+from __future__ import with_statement
+
 __revision__ = '$Id$'
 
 
 import os
 import sys
 import itertools
+import contextlib
 import textwrap
 import re
+import errno
 import locale
+import datetime
 
 # tel modules
-from tel import phonebook, config
+from tel import phonebook, config, daemonpath
+from tel import query
+from tel.query import Regex, Or, Sort, Query
 from tel.cmdoptparse import CommandOptionParser, make_option
 # encoding stuff
 from tel.encodinghelper import (stderr, stdout, stdout_encoding, exit,
-                                raw_input)
+                                raw_input, BulkWriter)
 
 
 _ = config.translation.ugettext
-
-
-try:
-    import readline
-    have_readline = True
-except ImportError:
-    msg = _('readline wasn\'t found, text editing capabilities are '
-            'restricted.')
-    print >> stderr, msg
-    have_readline = False
+ngettext = config.translation.ungettext
 
 
 class ConsoleEntryEditor(object):
-    """This class provides a simple console-based entry editor.
+    """This class provides a simple console-based entry editor. It is used,
+    if readline isn't available. Use create_entry_editor to get the best
+    editor.
 
     :ivar current_field: The name of the currently edited field"""
 
@@ -95,113 +95,161 @@ class ConsoleEntryEditor(object):
         self.finalize_editor()
         return entry
 
+    def initialize_editor(self):
+        pass
+    finalize_editor = initialize_editor
 
-    if have_readline:
-        # input methods supporting readline
-        def print_help(self, new):
-            print >> stdout, _('Please fill the following fields!')
+    def print_help(self, new):
+        """Print a little editing help"""
+        if new:
+            help = _('Please fill the following fields!')
+        else:
+            help = _('Please fill the following fields! The current '
+                     'value is shown in square brackets. NOTE: The '
+                     'current value is not preserved. You have to '
+                     're-enter every value!')
+        print >> stdout, textwrap.fill(help, 79)
+
+    def get_input(self, field, oldvalue, new):
+        """Gets a value from command line input.
+
+        :param field: The fieldname of the edited field
+        :param oldvalue: The old value of the field
+        :param new: Whether the entry is new"""
+        if new:
+            prompt = '%s: ' % phonebook.translate_field(field)
+        else:
+            prompt = '%s [%s]: '
+            prompt = prompt % (phonebook.translate_field(field),
+                               oldvalue)
+        return raw_input(prompt)
 
-        def initialize_editor(self):
-            """Initialize the editor"""
-            readline.set_pre_input_hook(self._input_hook)
 
-        def finalize_editor(self):
-            readline.set_pre_input_hook(None)
+class ReadlineEntryEditor(ConsoleEntryEditor):
+    """An entry editor, which uses readline to display the current value
+    in the input line.
 
-        def get_input(self, field, oldvalue, new):
-            """Gets a value from command line input.
+    :ivar readline: The readline module"""
 
-            :param field: The fieldname of the edited field
-            :param oldvalue: The old value of the field
-            :param new: Whether the entry is new"""
-            if not new:
-                self.oldvalue = oldvalue
-            else:
-                self.oldvalue = None
-            prompt = u'%s: ' % phonebook.translate_field(field)
-            return raw_input(prompt)
+    def __init__(self, readline, fields, new=False):
+        self.readline = readline
+        ConsoleEntryEditor.__init__(self, fields, new)
 
-        def _input_hook(self):
-            """displays the current value in the input line"""
-            if self.oldvalue:
-                text = self.oldvalue.encode(stdout_encoding)
-                readline.insert_text(text)
-                readline.redisplay()
+    def print_help(self, new):
+        print >> stdout, _('Please fill the following fields!')
+
+    def initialize_editor(self):
+        """Initialize the editor"""
+        self.readline.set_pre_input_hook(self._input_hook)
+
+    def finalize_editor(self):
+        self.readline.set_pre_input_hook(None)
+
+    def get_input(self, field, oldvalue, new):
+        """Gets a value from command line input.
+
+        :param field: The fieldname of the edited field
+        :param oldvalue: The old value of the field
+        :param new: Whether the entry is new"""
+        if not new:
+            self.oldvalue = oldvalue
+        else:
+            self.oldvalue = None
+        prompt = u'%s: ' % phonebook.translate_field(field)
+        return raw_input(prompt)
+
+    def _input_hook(self):
+        """displays the current value in the input line"""
+        if self.oldvalue:
+            text = self.oldvalue.encode(stdout_encoding)
+            self.readline.insert_text(text)
+            self.readline.redisplay()
+
+
+def create_entry_editor(fields, new=False):
+    """Returns a ReadlineEntryEditor, or a ConsoleEntryEditor, if readline
+    isn't available. readline is only imported here, because most commands
+    don't need it.
+
+    :param fields: The fields to edit
+    :param new: True, if mainly new entries are edited"""
+    try:
+        import readline
+    except ImportError:
+        msg = _('readline wasn\'t found, text editing capabilities are '
+                'restricted.')
+        print >> stderr, msg
+        return ConsoleEntryEditor(fields, new)
+    return ReadlineEntryEditor(readline, fields, new)
+
+
+# number of rows, which determine the column widths of streamed tables
+WIDTH_SAMPLE_SIZE = 100
 
-    else:
-        # don't do anything
 
-        def initialize_editor(self):
-            pass
-        finalize_editor = initialize_editor
-
-        def print_help(self, new):
-            """Print a little editing help"""
-            if new:
-                help = _('Please fill the following fields!')
-            else:
-                help = _('Please fill the following fields! The current '
-                         'value is shown in square brackets. NOTE: The '
-                         'current value is not preserved. You have to '
-                         're-enter every value!')
-            print >> stdout, textwrap.fill(help, 79)
-
-        def get_input(self, field, oldvalue, new):
-            """Gets a value from command line input.
-
-            :param field: The fieldname of the edited field
-            :param oldvalue: The old value of the field
-            :param new: Whether the entry is new"""
-            if new:
-                prompt = '%s: ' % phonebook.translate_field(field)
-            else:
-                prompt = '%s [%s]: '
-                prompt = prompt % (phonebook.translate_field(field),
-                                   oldvalue)
-            return raw_input(prompt)
-
-
-# output and utility functions
 def print_short_list(entries):
     """Prints all `entries` in a short format."""
-    print
-    for entry in entries:
-        print >> stdout, entry
+    with BulkWriter() as output:
+        output.write(u'\n')
+        output.writelines(u'%s\n' % entry for entry in entries)
 
 def print_long_list(entries):
-    """Prints every single entry in `entries` in full detail.
-    :param sortby: The field to sort by
-    :param asc: True, if sorting order is descending"""
-    for entry in entries:
-        print >> stdout, '-'*20
-        print >> stdout, entry.prettify()
+    """Prints every single entry in `entries` in full detail."""
+    separator = u'-' * 20 + u'\n'
+    id_format = _('ID:             %s') + u'\n'
+    with BulkWriter() as output:
+        for entry in entries:
+            output.write(separator)
+            output.write(id_format % entry.id)
+            output.write(entry.prettify() + u'\n')
 
-def print_entries_table(entries, fields):
+def print_entries_table(entries, fields, widths='exact'):
     """Prints `entries` as a table.
-    :param fields: Fields to include in the table"""
-    print
+    :param fields: Fields to include in the table
+    :param widths: How column widths are determined. 'exact' uses the
+    widest value of every column, so all rows are created before the first
+    one is printed. 'sample' uses the widest value among the first
+    WIDTH_SAMPLE_SIZE rows, longer values exceed their column. A list of
+    integers specifies fixed widths, the last one is used for remaining
+    columns and longer values are cut. With the latter two, rows are
+    printed as they are created."""
     # this is the head line of the table
     headline = map(phonebook.translate_field, fields)
-    table_body = []
-    # widths for each column
-    column_widths = map(len, headline)
-    for entry in entries:
-        # create and add a row for each entry
-        row = [unicode(entry[field]) for field in fields]
-        table_body.append(row)
-        # correct the column width, if an entry is too width
-        column_widths = map(max, map(len, row), column_widths)
+    table_body = (tuple(map(unicode, map(entry.__getitem__, fields)))
+                  for entry in entries)
+    if widths == 'exact':
+        table_body = list(table_body)
+        sample = table_body
+    elif widths == 'sample':
+        sample = list(itertools.islice(table_body, WIDTH_SAMPLE_SIZE))
+        table_body = itertools.chain(sample, table_body)
+    else:
+        sample = None
+    if sample is not None:
+        # widths for each column, widened to the widest value
+        column_widths = map(len, headline)
+        if sample:
+            column_widths = map(max, column_widths,
+                                [max(itertools.imap(len, column))
+                                 for column in zip(*sample)])
+        cell_formats = [u'%%-%ds' % width for width in column_widths]
+    else:
+        column_widths = (widths + widths[-1:] * len(fields))[:len(fields)]
+        headline = [title[:width] for (title, width) in
+                    zip(headline, column_widths)]
+        # the precision cuts longer values
+        cell_formats = [u'%%-%d.%ds' % (width, width) for width in
+                        column_widths]
     # print the headline
     headline = itertools.imap(unicode.center, headline, column_widths)
     headline = u'| %s |' % u' | '.join(headline)
     separator = (u'-'*(width+2) for width in column_widths)
     separator = u'|%s|' % u'+'.join(separator)
-    print >> stdout, headline
-    print >> stdout, separator
-    for row in table_body:
-        row = itertools.imap(unicode.ljust, row, column_widths)
-        row = u'| %s |' % u' | '.join(row)
-        print >> stdout, row
+    # formatting a row at once is much faster than padding every value
+    row_format = u'| %s |\n' % u' | '.join(cell_formats)
+    with BulkWriter() as output:
+        output.write(u'\n%s\n%s\n' % (headline, separator))
+        output.writelines(row_format % row for row in table_body)
 
 
 def print_simple_table(headline, items):
@@ -219,6 +267,101 @@ def print_simple_table(headline, items):
         print >> stdout, ' %s' % u' - '.join(item)
 
 
+def machine_value(value):
+    """Returns `value` as unicode string for machine-readable output. Dates
+    are formatted according to ISO 8601 instead of the locale."""
+    if isinstance(value, datetime.date):
+        return unicode(value.isoformat())
+    return unicode(value)
+
+
+def _jsonl_records(entries, fields):
+    """Yields every entry as a JSON object on a single line"""
+    try:
+        import json
+    except ImportError:
+        # python versions before 2.6
+        import simplejson as json
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    # keep the order of fields
+    keys = [encode(field) for field in fields]
+    for entry in entries:
+        members = [u'"id": %s' % encode(entry.id)]
+        members.extend(u'%s: %s' % (key, encode(machine_value(entry[field])))
+                       for (key, field) in zip(keys, fields))
+        yield u'{%s}\n' % u', '.join(members)
+
+
+# escapes of characters, which can't appear in tsv fields
+TSV_ESCAPES = {u'\\': u'\\\\', u'\t': u'\\t', u'\n': u'\\n', u'\r': u'\\r'}
+_tsv_special = re.compile(ur'[\\\t\n\r]')
+
+
+def _tsv_escape(value):
+    """Escapes backslashes, tabs and line breaks in `value`"""
+    return _tsv_special.sub(lambda match: TSV_ESCAPES[match.group()], value)
+
+
+def _tsv_records(entries, fields):
+    """Yields a header line with field names and a line of tab separated
+    values for every entry"""
+    yield u'%s\n' % u'\t'.join(['id'] + list(fields))
+    for entry in entries:
+        values = [_tsv_escape(machine_value(entry[field]))
+                  for field in fields]
+        yield u'%s\t%s\n' % (entry.id, u'\t'.join(values))
+
+
+def _nul_records(entries, fields):
+    """Yields every entry as a sequence of values, each of them terminated
+    by a NUL character"""
+    for entry in entries:
+        values = [machine_value(entry[field]) for field in fields]
+        yield u'%s\0%s\0' % (entry.id, u'\0'.join(values))
+
+
+# machine-readable output formats
+DUMP_FORMATS = {'jsonl': _jsonl_records, 'tsv': _tsv_records,
+                'nul': _nul_records}
+
+
+def dump_entries(entries, fields, format='jsonl'):
+    """Writes `entries` in a machine-readable format. Entries are written
+    in the order of `entries` as they come, the output is always encoded in
+    UTF-8.
+
+    :param fields: The fields to write. The id of entries is always
+    written first.
+    :param format: A key of DUMP_FORMATS"""
+    with BulkWriter(encoding='utf-8') as output:
+        output.writelines(DUMP_FORMATS[format](entries, fields))
+
+
+def combine_patterns(regexes):
+    """Combines the compiled regular expressions `regexes` into as few
+    expressions as possible. Returns a list of compiled expressions, one of
+    which matches a string, if any of `regexes` matches it.
+
+    If possible the expressions are joined into one alternation, so that
+    every string is searched once. Expressions with inline flags or more
+    than one expression with groups can't be joined, because flags apply to
+    the whole pattern and group numbers would change."""
+    if len(regexes) == 1:
+        return regexes
+    flags = regexes[0].flags
+    with_groups = [regex for regex in regexes if regex.groups]
+    if len(with_groups) <= 1 and all(r.flags == flags for r in regexes):
+        # the expression with groups must come first to keep the numbers
+        # of its groups
+        ordered = with_groups + [r for r in regexes if not r.groups]
+        pattern = u'|'.join(u'(?:%s)' % r.pattern for r in ordered)
+        try:
+            return [re.compile(pattern, flags)]
+        except re.error:
+            pass
+    return regexes
+
+
 def yes_no_question(question):
     """Asks `question` as a yes/no question. Returns True, if the user
     answered yes, otherwise False."""
@@ -231,72 +374,154 @@ def yes_no_question(question):
 class ConsoleIFace(object):
     """Provides a console interface to Tel"""
 
+    # commands, which don't modify the phonebook. The phonebook is loaded
+    # lazily for these commands, so that entries and values are only
+    # parsed, if they are really needed.
+    read_only_commands = ('list', 'table', 'show', 'dump', 'lookup_number')
+    # commands, which don't need a phonebook at all or load it themselves
+    standalone_commands = ('help_fields', 'help_backends', 'daemon')
+
     def __init__(self):
         self.phonebook = None
 
+    @contextlib.contextmanager
+    def _saving(self):
+        """Saves the phonebook once after the with block. Exits with an
+        error message, if saving fails. Errors raised in the with block are
+        passed on, the phonebook isn't saved then."""
+        # True, once the with block was left normally
+        saving = False
+        try:
+            with self.phonebook.batch():
+                yield
+                saving = True
+                # deferred until the batch is left
+                self.phonebook.save()
+        except Exception, exp:
+            if not saving:
+                raise
+            args = {
+                'uri': self.phonebook.uri,
+                'message': (exp.strerror if
+                            isinstance(exp, EnvironmentError)
+                            else exp.message)}
+            exit(_('Couldn\'t save %(uri)s: %(message)s') % args)
+
     def edit_entries(self, entries):
         """Allows interactive editing of entries. If `new` is True, `entry`
         is identified as new entry"""
-        editor = ConsoleEntryEditor(self.phonebook.supported_fields(),
-                                    bool(entries[0].parent))
-        for entry in entries:
-            entry = editor.edit(entry)
-            # check if the user wants to add an empty entry
-            if not entry:
-                question = _('Do you really want to save an emtpy entry?')
-                if not yes_no_question(question):
-                    # abort without saving
-                    print >> stdout, _('The entry is not saved.')
-                    return
-            if entry.parent is None:
-                self.phonebook.add(entry)
-            try:
-                self.phonebook.save()
-                print >> stdout, _('The entry was saved.')
-            except Exception, exp:
-                args = {
-                    'uri': self.phonebook.uri,
-                    'message': (exp.strerror if
-                                isinstance(exp, EnvironmentError)
-                                else exp.message)}
-
-                exit(_('Couldn\'t save %(uri)s: %(message)s') % args)
-
+        editor = create_entry_editor(self.phonebook.supported_fields(),
+                                     bool(entries[0].parent))
+        saved = 0
+        with self._saving():
+            for entry in entries:
+                oldvalues = entry.items()
+                entry = editor.edit(entry)
+                # check if the user wants to add an empty entry
+                if not entry:
+                    question = _('Do you really want to save an emtpy '
+                                 'entry?')
+                    if not yes_no_question(question):
+                        # abort without saving this entry. It was edited
+                        # in place, so restore it, before the entries
+                        # edited so far are saved.
+                        entry.update(oldvalues)
+                        print >> stdout, _('The entry is not saved.')
+                        break
+                if entry.parent is None:
+                    self.phonebook.add(entry)
+                saved += 1
+        if saved:
+            print >> stdout, ngettext('%d entry was saved.',
+                                      '%d entries were saved.',
+                                      saved) % saved
 
     def _find_entries(self, options, *args):
         """Finds entries according to command line arguments"""
-        entries = self.phonebook
-        if not args:
-            return entries
+        if not args and not options.ids:
+            return self.phonebook
+        return list(self._iter_entries(options, *args))
+
+    def _iter_entries(self, options, *args):
+        """Finds entries according to command line arguments. Returns an
+        iterator, which yields entries as soon as they are found."""
+        if not args and not options.ids:
+            return iter(self.phonebook)
 
-        patterns = args
+        entries = []
+        for entry_id in (options.ids or ()):
+            try:
+                entries.append(self.phonebook.by_id(entry_id))
+            except KeyError:
+                print >> stderr, _('There is no entry with id %s.') % entry_id
+        where = self._search_predicate(options, *args)
+        matching = (self.phonebook.execute(Query(where)) if where is not None
+                    else ())
+        return self._unique_entries(itertools.chain(entries, matching))
+
+    def _search_predicate(self, options, *args):
+        """Returns a predicate, which matches entries, if any of the
+        patterns in `args` matches any of the searched fields, or None, if
+        there are no valid patterns. With --query `args` are parsed as a
+        single query instead."""
+        if options.query:
+            try:
+                return query.parse(u' '.join(args),
+                                   self.phonebook.supported_fields(),
+                                   options.fields, options.ignore_case)
+            except query.QueryError, err:
+                exit(err.message)
         flags = re.UNICODE
         if options.ignore_case:
             flags |= re.IGNORECASE
 
-        entries = []
-        for pat in patterns:
+        regexes = []
+        for pat in args:
             try:
-                entries.extend(self.phonebook.find_all(re.compile(pat,
-                                                                  flags),
-                                                       *options.fields))
+                regexes.append(re.compile(pat, flags))
             except re.error, err:
                 msg = _('Search pattern "%(pattern)s" invalid: %(message)s')
                 print >> stderr, msg % {'pattern': pat,
                                         'message': unicode(err)}
-        # remove double entries
-        return list(set(entries))
+        if not regexes:
+            return None
+        # test every field once against all patterns
+        return Or(*[Regex(field, regex) for regex in
+                    combine_patterns(regexes) for field in options.fields])
+
+    @staticmethod
+    def _unique_entries(entries):
+        """Removes entries selected by id and pattern, keeps the order"""
+        seen = set()
+        for entry in entries:
+            if entry.id not in seen:
+                seen.add(entry.id)
+                yield entry
 
     def _get_entries_from_options(self, options, *args):
         """Analyzes arguments and options, and returns a list of entries
         that should be worked with"""
-        # sort entries
-        return phonebook.sort_by_field(self._find_entries(options, *args),
-                                        # the field to sort by
-                                       options.sortby[0],
-                                       # ascending or descending
-                                       options.sortby[1],
-                                       options.ignore_case)
+        field, descending = options.sortby
+        if options.ids:
+            # entries selected by id are merged with matching entries
+            entries = self._find_entries(options, *args)
+            return phonebook.sort_by_field(entries, field, descending,
+                                           options.ignore_case,
+                                           options.limit)
+        where = None
+        if args:
+            where = self._search_predicate(options, *args)
+            if where is None:
+                return []
+        elif field in config.sort_index_fields:
+            # all entries are sorted, use a persistent index to avoid
+            # sorting on every invocation
+            self.phonebook.create_sort_index(field, options.ignore_case,
+                                             persistent=True)
+        # let the backend search and sort, if it can
+        query = Query(where, Sort(field, descending, options.ignore_case),
+                      options.limit)
+        return list(self.phonebook.execute(query))
 
 
     ## COMMAND FUNCTIONS
@@ -326,7 +551,7 @@ class ConsoleIFace(object):
     def _cmd_table(self, options, *args):
         """Print a table"""
         entries = self._get_entries_from_options(options, *args)
-        print_entries_table(entries, options.output)
+        print_entries_table(entries, options.output, options.widths)
 
     def _cmd_list(self, options, *args):
         """Print a short list of entries"""
@@ -338,6 +563,26 @@ class ConsoleIFace(object):
         entries = self._get_entries_from_options(options, *args)
         print_long_list(entries)
 
+    def _cmd_dump(self, options, *args):
+        """Writes entries in a machine-readable format. Entries are not
+        sorted, but written as soon as they are found."""
+        entries = self._iter_entries(options, *args)
+        dump_entries(entries, options.output, options.format)
+
+    def _cmd_lookup_number(self, options, *args):
+        """Prints the entries containing the given phone numbers"""
+        self.phonebook.create_number_index(config.country_code)
+        entries = []
+        for number in args:
+            found = self.phonebook.lookup_number(number)
+            if not found:
+                print >> stderr, _('There is no entry with number %s.') % \
+                      number
+            entries.extend(found)
+        if not entries:
+            exit(1)
+        print_short_list(self._unique_entries(entries))
+
     def _cmd_create(self, options, *args):
         """Interactivly create a new entry"""
         number = 1
@@ -348,8 +593,7 @@ class ConsoleIFace(object):
                 exit(_('--create needs a number.'))
         if len(args) > 1:
             exit(_('--create only accepts one argument.'))
-        entries = [Entry() for Entry in itertools.repeat(phonebook.Entry,
-                                                         number)]
+        entries = [self.phonebook.new_entry() for i in xrange(number)]
         self.edit_entries(entries)
 
     def _cmd_edit(self, options, *args):
@@ -360,10 +604,27 @@ class ConsoleIFace(object):
         self.edit_entries(entries)
 
     def _cmd_remove(self, options, *args):
-        for entry in self._find_entries(options, *args):
-            if yes_no_question(_('Really delete entry "%s"?') % entry):
-                self.phonebook.remove(entry)
-        self.phonebook.save()
+        with self._saving():
+            for entry in self._find_entries(options, *args):
+                if yes_no_question(_('Really delete entry "%s"?') % entry):
+                    self.phonebook.remove(entry)
+
+    def _cmd_daemon(self, options, *args):
+        """Serves the phonebook to other invocations until interrupted"""
+        from tel import daemon
+        try:
+            server = daemon.LookupDaemon(options.uri)
+        except Exception, exp:
+            exit(_('Couldn\'t load %(uri)s: %(message)s') %
+                 {'message': exp.message, 'uri': options.uri})
+        try:
+            server.bind()
+        except EnvironmentError, exp:
+            exit(exp.strerror or exp.message)
+        print >> stdout, _('Serving %(uri)s at %(path)s.') % {
+            'uri': server.phonebook.uri, 'path': server.path}
+        stdout.flush()
+        server.serve_forever()
 
     def _cmd_help_fields(self, options, *args):
         if not args:
@@ -431,8 +692,13 @@ Supported fields:
                                        'phonebook.csv'),
         'output': phonebook.FIELDS,
         'ignore_case': False,
+        'query': False,
         'sortby': ('lastname', False),
-        'fields': phonebook.FIELDS
+        'fields': phonebook.FIELDS,
+        'ids': None,
+        'limit': None,
+        'widths': 'exact',
+        'format': 'jsonl'
         }
 
     global_options = [
@@ -444,20 +710,47 @@ Supported fields:
     command_options = [
         # command options
         make_option('--list', action='command',
-                    options=('--sort-by', '--ignore-case', '--fields'),
+                    options=('--sort-by', '--limit', '--ignore-case',
+                             '--query', '--fields', '--id'),
                     help=_('print a short list of the specified entries.')),
         make_option('--table', action='command',
                     help=_('print a table with the specified entries.'),
-                    options=('--output', '--sort-by', '--ignore-case',
-                             '--fields')),
+                    options=('--output', '--widths', '--sort-by',
+                             '--limit', '--ignore-case', '--query',
+                             '--fields', '--id')),
         make_option('--show', action='command',
-                    options=('--sort-by', '--ignore-case', '--fields'),
+                    options=('--sort-by', '--limit', '--ignore-case',
+                             '--query', '--fields', '--id'),
                     help=_('show the specified entries.')),
+        make_option('--dump', action='command',
+                    options=('--format', '--output', '--ignore-case',
+                             '--query', '--fields', '--id'),
+                    help=_('write the specified entries in a '
+                           'machine-readable format. Entries are written '
+                           'unsorted, as soon as they are found.')),
+        make_option('--lookup-number', action='command', args='required',
+                    metavar=_('numbers'),
+                    help=_('print the entries containing any of the given '
+                           'phone numbers in a phone or mobile field. '
+                           'Formatting is ignored, national numbers are '
+                           'compared with international ones, if the '
+                           'environment variable TEL_COUNTRY_CODE contains '
+                           'the country code, e.g. 49.')),
+        make_option('--daemon', action='command', args='no',
+                    help=_('keep the phonebook loaded and answer the '
+                           'commands --list, --table, --show, --dump and '
+                           '--lookup-number of other invocations of tel '
+                           'for the same phonebook, until interrupted. '
+                           'Changes to the phonebook file are noticed.')),
         make_option('--create', action='command', metavar=_('number'),
                     help=_('create the specified number of new entries.')),
         make_option('--edit', action='command', args='required',
+                    options=('--ignore-case', '--query', '--fields',
+                             '--id'),
                     help=_('edit the specified entries.')),
         make_option('--remove', action='command', args='required',
+                    options=('--ignore-case', '--query', '--fields',
+                             '--id'),
                     help=_('remove the specified entries.')),
         ## make_option('--export', action='command', args='required',
         ##             help=_('export phone book to all specified locations.'),
@@ -472,12 +765,31 @@ Supported fields:
                     dest='ignore_case',
                     help=_('ignore case, when searching or sorting. The '
                            'default is not to ignore case.')),
+        make_option('-q', '--query', action='store_true', dest='query',
+                    help=_('interpret the arguments as a query instead of '
+                           'regular expressions. A query combines terms '
+                           'with AND and OR and groups them with '
+                           'parentheses. "field=value" selects entries, '
+                           'whose field equals value (dates as '
+                           'YYYY-MM-DD), "field^=value" '
+                           'entries, whose field starts with value, and '
+                           '"field~regex" entries, whose field matches the '
+                           'regular expression. A plain regular expression '
+                           'is searched in all fields given by --fields. '
+                           'Values containing spaces or parentheses are '
+                           'quoted with ", '
+                           'e.g. \'town="New York" AND tags~work\'.')),
         make_option('-f', '--fields', action='store', dest='fields',
                     type='field_list', metavar=_('fields'),
                     help=_('specify a list of fields to search in. Takes a '
                            'comma-separated list of internal names as '
                            'printed by --help-fields. Fields prefixed with '
-                           '"-" are not searched.'))
+                           '"-" are not searched.')),
+        make_option('--id', action='append', dest='ids',
+                    metavar=_('id'),
+                    help=_('select the entry with the given id as printed '
+                           'by --show, in addition to the entries matching '
+                           'patterns. May be given more than once.'))
         ]
 
     local_options = [
@@ -489,10 +801,35 @@ Supported fields:
                            'order is ascending, if prefixed with a -, '
                            'sorting order is descending. The default is '
                            'ascending, if no prefix is used.')),
+        make_option('-l', '--limit', action='store', dest='limit',
+                    type='int', metavar=_('number'),
+                    help=_('show only the first entries according to the '
+                           'sorting order. This is faster than sorting all '
+                           'entries.')),
         make_option('-o', '--output', action='store', dest='output',
                     type='field_list', metavar=_('fields'),
                     help=_('specify the fields to show. Uses the same '
-                           'syntax as the --fields option.'))
+                           'syntax as the --fields option.')),
+        make_option('-w', '--widths', action='store', dest='widths',
+                    type='widths', metavar=_('widths'),
+                    help=_('specify the column widths of tables. "exact" '
+                           'fits the columns to all entries, before the '
+                           'table is printed. This is the default. '
+                           '"sample" fits the columns to the first %d '
+                           'entries and prints entries as they are found. '
+                           'A comma-separated list of numbers sets fixed '
+                           'widths, the last one applies to all remaining '
+                           'columns, longer values are cut.') %
+                    WIDTH_SAMPLE_SIZE),
+        make_option('--format', action='store', dest='format',
+                    type='choice', choices=sorted(DUMP_FORMATS),
+                    metavar=_('format'),
+                    help=_('specify the format of --dump. "jsonl" writes '
+                           'a JSON object per line, "tsv" tab separated '
+                           'values with a header line, "nul" terminates '
+                           'every value with a NUL character. The id of '
+                           'entries comes first, dates are written as '
+                           'YYYY-MM-DD. The default is "jsonl".'))
         ]
 
     def _parse_args(self, args):
@@ -512,7 +849,8 @@ Supported fields:
         desc = _('Commands to modify the phone book and to search or '
                  'print entries. Only one of these options may be '
                  'specified.\n'
-                 'Entries are specified through regular expressions. '
+                 'Entries are specified through regular expressions '
+                 'or, with --query, through a query. '
                  'See http://docs.python.org/lib/re-syntax.html for a '
                  'description of regular expression syntax.')
         group = parser.add_option_group(_('Commands'), desc)
@@ -537,9 +875,11 @@ Supported fields:
         if not hasattr(options, 'command'):
             parser.error(_('Please specify a command!'))
 
-        if options.args == 'required' and not args:
+        if options.args == 'required' and not args and not options.ids:
             msg = _('The command %s need arguments.')
             parser.error(msg % options.command)
+        elif options.limit is not None and options.limit < 1:
+            parser.error(_('--limit needs a positive number.'))
         elif options.args == 'no' and args:
             msg = _('The command %s doesn\'t take any arguments.')
             parser.error(msg % options.command)
@@ -548,6 +888,27 @@ Supported fields:
         options.command_function = self._get_cmd_function(options.command)
         return (options, args)
 
+    def _load_phonebook(self, options):
+        """Opens and loads the phonebook given by `options`. Exits with an
+        error message, if loading fails."""
+        try:
+            self.phonebook = phonebook.phonebook_open(options.uri)
+            lazy = options.command in self.read_only_commands
+            if lazy and daemonpath.daemon_exists(self.phonebook.uri):
+                # a daemon has the phonebook loaded already
+                from tel import daemon
+                served = daemon.connect(self.phonebook.uri)
+                if served is not None:
+                    self.phonebook = served
+                    return
+            self.phonebook.load(lazy=lazy, lazy_types=lazy)
+        except Exception, exp:
+            msg = (_('Couldn\'t load %(uri)s: %(message)s') %
+                     {'message': exp.message,
+                      'uri': (getattr(self.phonebook, 'uri', None)
+                              or options.uri)})
+            exit(msg)
+
     def start(self):
         """Starts the interface"""
         try:
@@ -555,16 +916,20 @@ Supported fields:
             args = [arg.decode(sys.getfilesystemencoding()) for arg in
                     sys.argv]
             (options, args) = self._parse_args(args)
+            if options.command not in self.standalone_commands:
+                self._load_phonebook(options)
             try:
-                self.phonebook = phonebook.phonebook_open(options.uri)
-                self.phonebook.load()
-            except Exception, exp:
-                msg = (_('Couldn\'t load %(uri)s: %(message)s') %
-                         {'message': exp.message,
-                          'uri': (getattr(self.phonebook, 'uri', None)
-                                  or options.uri)})
+                options.command_function(options, *args)
+            except IOError, exp:
+                if exp.errno != errno.EPIPE:
+                    raise
+                # the reader of a pipe exited, e.g. head
+                exit(None)
+            except phonebook.InvalidValue, exp:
+                # raised by lazily converted, invalid field values
+                msg = (_('Invalid value in %(uri)s: %(message)s') %
+                       {'message': exp.message, 'uri': self.phonebook.uri})
                 exit(msg)
-            options.command_function(options, *args)
         except KeyboardInterrupt:
             exit(_('Dying peacefully ...'))
 
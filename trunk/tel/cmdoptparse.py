@@ -98,7 +98,7 @@ class CommandOption(Option):
     ACTIONS = Option.ACTIONS[:]
     ATTRS = Option.ATTRS[:]
     TYPES = Option.TYPES[:]
-    TYPES += ('field_list', 'field')
+    TYPES += ('field_list', 'field', 'widths')
     ATTRS += ['args', 'options']
     ACTIONS += ('copyright', 'authors', 'license', 'command')
 
@@ -153,9 +153,24 @@ class CommandOption(Option):
         else:
             return (fieldname, value.startswith('-'))
 
+    def _check_widths(self, opt, value):
+        """Parse column widths into either 'exact', 'sample' or a list of
+        positive integers"""
+        value = value.strip()
+        if value in ('exact', 'sample'):
+            return value
+        try:
+            widths = [int(item) for item in value.split(',')]
+        except ValueError:
+            raise OptionValueError('Invalid column widths %s.' % value)
+        if min(widths) < 1:
+            raise OptionValueError('Invalid column widths %s.' % value)
+        return widths
+
     CHECK_METHODS += [_check_attrs, _check_options]
     TYPE_CHECKER['field_list'] = _check_field_list
     TYPE_CHECKER['field'] = _check_field
+    TYPE_CHECKER['widths'] = _check_widths
 
     def take_action(self, action, dest, opt, value, values, parser):
         """Executes `action`"""
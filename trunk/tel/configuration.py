@@ -110,6 +110,19 @@ class Configuration(object):
             self._backend_directories = def_dirs
         return self._backend_directories
 
+    @property
+    def sort_index_fields(self):
+        """Fields, for which persistent sort indexes are maintained"""
+        return ('lastname', 'firstname', 'town')
+
+    @property
+    def country_code(self):
+        """The country code of national phone numbers (like "49"), which is
+        used to normalize phone numbers. It is read from the environment
+        variable TEL_COUNTRY_CODE. None, if it is not set."""
+        code = os.environ.get('TEL_COUNTRY_CODE', '').strip().lstrip('+')
+        return (unicode(code) if code.isdigit() else None)
+
     @property
     def long_entry_format(self):
         """A nice readable entry format"""
@@ -118,11 +131,11 @@ class Configuration(object):
             msg = _('Name:           %(title)s %(firstname)s %(lastname)s\n'
                     'Address:        %(street)s\n'
                     '                %(country)s, %(postcode)s %(town)s\n'
-                    'POB:            %(postbox)s\n'
+                    'POB:            %(pob)s\n'
                     'E-Mail:         %(email)s\n'
                     'Phone:          %(phone)s\n'
                     'Mobile:         %(mobile)s\n'
-                    'Date of birth:  %(birthdate)s\n'
+                    'Date of birth:  %(birthday)s\n'
                     'Tags:           %(tags)s\n')
             self._long_entry_format = msg
         return self._long_entry_format
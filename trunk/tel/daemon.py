@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# daemon answering queries on a phonebook over a unix socket
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+"""This module provides a daemon, which keeps a phonebook in memory and
+answers queries over a unix domain socket, and a client phonebook class
+using it.
+
+The daemon loads the phonebook once and maintains field, sort and number
+indexes. Before every request it checks the modification time of the
+phonebook file and reloads it, if it changed.
+
+Requests and responses are UTF-8 encoded lines. A request is a JSON
+array of the request name and its arguments:
+
+    ["ping"]
+    ["query", query]            (query as returned by tel.query.to_data)
+    ["by_id", entry id]
+    ["lookup", phone number, country code or null]
+
+The daemon answers with a line for every entry found, a JSON array of the
+entry id and the values of all fields ordered like phonebook.FIELDS,
+followed by a line "OK" or a line "ERROR message". Values are strings,
+dates are written as YYYY-MM-DD. A connection may be used for any
+number of requests. Every connection is served by its own thread, requests
+are answered one at a time."""
+
+
+from __future__ import with_statement
+
+
+__revision__ = '$Id$'
+
+
+import os
+import errno
+import signal
+import socket
+import datetime
+import threading
+import SocketServer
+
+try:
+    import json
+except ImportError:
+    # python versions before 2.6
+    import simplejson as json
+
+from tel import phonebook, query, config
+from tel.phonebook import FIELDS, Phonebook, CompactEntry
+from tel.daemonpath import socket_path
+
+
+_ = config.translation.ugettext
+
+
+# fields, for which the daemon maintains inverted indexes
+INDEX_FIELDS = ('firstname', 'lastname', 'nickname', 'town', 'email',
+                'tags')
+# seconds, which clients wait for answers
+TIMEOUT = 30.0
+
+
+class DaemonError(IOError):
+    """Raised by clients, if the daemon answers with an error"""
+
+
+def _encode_entry(entry):
+    """Returns the response line for `entry`"""
+    values = [entry.id]
+    for field in FIELDS:
+        value = entry[field]
+        if isinstance(value, datetime.date):
+            value = value.isoformat()
+        values.append(unicode(value))
+    return json.dumps(values) + '\n'
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """Answers the requests of a single connection"""
+
+    # write responses in large chunks
+    wbufsize = 65536
+
+    def handle(self):
+        daemon = self.server.lookup_daemon
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                with daemon.lock:
+                    lines = [_encode_entry(entry) for entry in
+                             daemon.answer(request[0], *request[1:])]
+                self.wfile.writelines(lines)
+            except Exception, exc:
+                message = (exc.message or exc.__class__.__name__)
+                self.wfile.write('ERROR %s\n' %
+                                 unicode(message).replace(u'\n', u' ')
+                                 .encode('utf-8'))
+            else:
+                self.wfile.write('OK\n')
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    # clients may keep their connection, so every connection gets a thread
+    daemon_threads = True
+    # a stale socket file is removed before binding
+    allow_reuse_address = False
+
+
+class LookupDaemon(object):
+    """Serves a phonebook over a unix domain socket.
+
+    :ivar phonebook: The served phonebook
+    :ivar path: The path of the socket
+    :ivar lock: Held while a request is answered, because phonebooks must
+    not be used by several threads at once"""
+
+    def __init__(self, uri):
+        self.phonebook = phonebook.phonebook_open(uri)
+        self.path = socket_path(self.phonebook.uri)
+        self.lock = threading.Lock()
+        # SocketServer.UnixStreamServer, created by bind
+        self._server = None
+        # size and modification time of the phonebook file after the last
+        # load
+        self._stat = None
+        self.load()
+
+    def _file_stat(self):
+        """Returns size and modification time of the phonebook file, or
+        None, if it is no file"""
+        try:
+            result = os.stat(self.phonebook.uri.location)
+        except OSError:
+            return None
+        return (result.st_size, result.st_mtime)
+
+    def load(self):
+        """Loads the phonebook and builds all indexes"""
+        book = self.phonebook
+        # filling a sort index is faster than inserting entries one by one
+        sort_indexes = [(index.field, index.ignore_case) for index in
+                        book._sort_indexes.values()]
+        for field, ignore_case in sort_indexes:
+            book.drop_sort_index(field, ignore_case)
+        self._stat = self._file_stat()
+        book.load()
+        book.create_index(*INDEX_FIELDS)
+        book.create_number_index(config.country_code)
+        for field in config.sort_index_fields:
+            book.create_sort_index(field, persistent=True)
+        for field, ignore_case in sort_indexes:
+            book.create_sort_index(field, ignore_case)
+
+    def check_reload(self):
+        """Reloads the phonebook, if its file changed"""
+        if self._file_stat() != self._stat:
+            self.load()
+
+    def answer(self, request, *args):
+        """Returns the entries answering `request` with `args`
+
+        :raises ValueError: If the request is invalid"""
+        self.check_reload()
+        book = self.phonebook
+        if request == 'ping':
+            return []
+        elif request == 'query':
+            query_ = query.from_data(*args)
+            if query_.sort is not None:
+                # sorting is requested again and again, keep the order
+                book.create_sort_index(query_.sort.field,
+                                       query_.sort.ignore_case)
+            return book.execute(query_)
+        elif request == 'by_id':
+            try:
+                return [book.by_id(*args)]
+            except KeyError:
+                return []
+        elif request == 'lookup':
+            number, country_code = args
+            book.create_number_index(country_code)
+            return book.lookup_number(number)
+        raise ValueError(_(u'Unknown request %s') % request)
+
+    def bind(self):
+        """Creates the server socket. Removes the socket file left by a
+        daemon, which didn't exit properly.
+
+        :raises EnvironmentError: If another daemon serves the phonebook"""
+        if os.path.exists(self.path):
+            sock = _connect(self.path)
+            if sock is not None:
+                sock.close()
+                raise EnvironmentError(
+                    errno.EADDRINUSE,
+                    _(u'Another daemon serves this phonebook at %s.') %
+                    self.path)
+            os.remove(self.path)
+        # only the user may connect
+        umask = os.umask(0077)
+        try:
+            server = _UnixServer(self.path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        server.lookup_daemon = self
+        self._server = server
+
+    def serve_forever(self):
+        """Answers requests until the process is interrupted or terminated.
+        Binds the socket, if bind wasn't called before. The socket file is
+        removed at exit."""
+        if self._server is None:
+            self.bind()
+        server = self._server
+        try:
+            # a stale socket would cost every command a failed connect, so
+            # leave through the finally clause on SIGTERM, too
+            previous = signal.signal(signal.SIGTERM, _terminate)
+        except ValueError:
+            # signal handlers can only be set in the main thread
+            previous = None
+        try:
+            server.serve_forever()
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)
+            server.server_close()
+            os.remove(self.path)
+
+    def shutdown(self):
+        """Stops serve_forever, which may run in another thread"""
+        self._server.shutdown()
+
+
+def _terminate(signum, frame):
+    """Exits on SIGTERM like on KeyboardInterrupt, running finally
+    clauses"""
+    raise SystemExit(_(u'Terminated.'))
+
+
+def _connect(path):
+    """Returns a socket connected to the daemon at `path` or None, if no
+    daemon is listening"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    sock.settimeout(TIMEOUT)
+    return sock
+
+
+class DaemonPhonebook(Phonebook):
+    """A read-only phonebook, which passes all queries to a daemon.
+
+    Entries are created for every answer and don't belong to the
+    phonebook, so they can't be changed."""
+
+    entry_class = CompactEntry
+
+    def __init__(self, uri, sock):
+        Phonebook.__init__(self, uri)
+        self._socket = sock
+        self._reader = sock.makefile('rb')
+        self._country_code = None
+
+    def _request(self, *request):
+        """Sends `request` and returns a list of the entries in the
+        answer"""
+        self._socket.sendall(json.dumps(request) + '\n')
+        entries = []
+        for line in self._reader:
+            if line.startswith('OK'):
+                return entries
+            if line.startswith('ERROR '):
+                raise DaemonError(line[6:].rstrip('\n').decode('utf-8'))
+            values = json.loads(line.decode('utf-8'))
+            entry = self.new_entry()
+            entry.id = values[0]
+            for field, value in zip(FIELDS, values[1:]):
+                entry.set_raw(field, value)
+            entries.append(entry)
+        raise DaemonError(_(u'The daemon closed the connection.'))
+
+    def ping(self):
+        """Raises an error, if the daemon doesn't answer"""
+        self._request('ping')
+
+    def close(self):
+        """Closes the connection to the daemon"""
+        self._reader.close()
+        self._socket.close()
+
+    def load(self, lazy=False, lazy_types=False):
+        """Entries are always loaded by the daemon"""
+        pass
+
+    def save(self):
+        raise IOError(_(u'The phonebook is read-only.'))
+
+    def _execute_query(self, query_):
+        return self._request('query', query.to_data(query_))
+
+    def __iter__(self):
+        return self.execute(query.Query())
+
+    def by_id(self, entry_id):
+        for entry in self._request('by_id', entry_id):
+            return entry
+        raise KeyError(entry_id)
+
+    def create_sort_index(self, field, ignore_case=False,
+                          persistent=False):
+        """Sort indexes are maintained by the daemon"""
+        if field not in self.supported_fields():
+            raise phonebook.NoSuchField(field)
+
+    def create_number_index(self, country_code=None):
+        """The number index is maintained by the daemon, this only sets
+        the country code for lookup_number"""
+        self._country_code = country_code
+
+    def lookup_number(self, number, country_code=None):
+        return self._request('lookup', number,
+                             country_code or self._country_code)
+
+
+def connect(uri):
+    """Returns a DaemonPhonebook for the phonebook `uri`, a phonebook.URI
+    object with scheme, or None, if no daemon serves this phonebook"""
+    path = socket_path(uri)
+    if not os.path.exists(path):
+        return None
+    sock = _connect(path)
+    if sock is None:
+        return None
+    book = DaemonPhonebook(uri, sock)
+    try:
+        book.ping()
+    except (EnvironmentError, socket.error, ValueError):
+        book.close()
+        return None
+    return book
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# locates the sockets of lookup daemons
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+"""This module locates the sockets of the daemons in tel.daemon.
+
+Every read-only command looks for a daemon, so this module must be cheap
+to import. tel.daemon loads socket, SocketServer and json, it is only
+imported, if a socket exists."""
+
+
+__revision__ = '$Id$'
+
+
+import os
+# already loaded by the csv backend
+import hashlib
+
+from tel import config
+
+
+def socket_path(uri):
+    """Returns the path of the socket of the daemon serving the phonebook
+    `uri`, a phonebook.URI object with scheme"""
+    location = uri.location
+    if os.path.exists(location):
+        location = os.path.realpath(location)
+    key = hashlib.md5(('%s://%s' % (uri.scheme, location)).encode('utf-8'))
+    return os.path.join(config.user_directory,
+                        'daemon-%s.sock' % key.hexdigest()[:16])
+
+
+def daemon_exists(uri):
+    """Returns True, if there is a socket for the phonebook `uri`. The
+    daemon may have exited without removing it, though."""
+    return os.path.exists(socket_path(uri))
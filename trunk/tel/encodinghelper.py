@@ -38,39 +38,59 @@ through a codecs.DataWriter.
 __revision__ = "$Id$"
 
 
+import os
 import sys
 import codecs
-import subprocess
+import locale
 
 
-def _read_locale():
-    """Asks the 'locale' command on unix like systems"""
-    process = subprocess.Popen(['locale'], stdout=subprocess.PIPE)
-    process.wait()
-    for line in process.stdout:
-        line = line.strip()
-        if line.startswith('LC_MESSAGES'):
-            return line.split('=')[1]
+# names of encodings, which are as good as no encoding at all
+ASCII_ENCODINGS = ('ASCII', 'US-ASCII', 'ANSI_X3.4-1968', 'POSIX')
+
+# the encoding of the locale, determined by _locale_encoding
+_locale_encoding_cache = None
+
+
+def _locale_encoding():
+    """Determines the encoding of the current locale from the environment.
+
+    This doesn't use the 'locale' command, because starting a process takes
+    much more time than anything else done at startup. The result is
+    memoised."""
+    global _locale_encoding_cache
+    if _locale_encoding_cache is None:
+        try:
+            # this honours LC_ALL, LC_CTYPE and LANG
+            enc = locale.getpreferredencoding()
+        except locale.Error:
+            enc = None
+        if not enc or enc.upper() in ASCII_ENCODINGS:
+            # the environment may name a locale, which is not installed
+            try:
+                enc = locale.getdefaultlocale()[1] or enc
+            except ValueError:
+                pass
+        _locale_encoding_cache = enc or ''
+    return _locale_encoding_cache
 
 
 def _get_encoding(outputstream):
     """Tries to determine encoding of standard output"""
     enc = (getattr(outputstream, "encoding", None) or
            sys.getfilesystemencoding())
-    if not enc:
+    if not enc or enc.upper() in ASCII_ENCODINGS:
         # if it's still not identified
         plat = sys.platform
         if plat.startswith("win"):
             enc = "cp850"
-        elif plat.startswith(("linux", "aix")):
-            # try to read locale output
-            enc = _read_locale()
         elif plat.startswith("cygwin"):
             enc = "raw_unicode_escape"
+        elif os.name == 'posix':
+            enc = _locale_encoding()
         else:
             enc = ""
-    if enc.upper() in ("ASCII", "US-ASCII", "ANSI_X3.4-1968", "POSIX"):
-        enc = ""
+    if not enc or enc.upper() in ASCII_ENCODINGS:
+        enc = "ascii"
     return enc
 
 
@@ -78,10 +98,70 @@ stdout_encoding = _get_encoding(sys.stdout)
 stderr_encoding = _get_encoding(sys.stderr)
 stdin_encoding = _get_encoding(sys.stdin)
 
-stdout = codecs.getwriter(stdout_encoding)(sys.stdout)
-stderr = codecs.getwriter(stderr_encoding)(sys.stderr)
+# unencodable characters are replaced instead of aborting the output
+stdout = codecs.getwriter(stdout_encoding)(sys.stdout, 'replace')
+stderr = codecs.getwriter(stderr_encoding)(sys.stderr, 'replace')
 stdin = codecs.getreader(stdin_encoding)(sys.stdin)
 
+
+class BulkWriter(object):
+    """Writes unicode text to a byte stream in large chunks.
+
+    Text is collected until `chunk_size` characters are pending, and then
+    encoded and written at once. This is much faster than the stream
+    writers of codecs, which encode every single write. Pending text is
+    written by flush and, if used in a with statement, at the end of the
+    block.
+
+    :ivar stream: The byte stream written to
+    :ivar encoding: The encoding of `stream`"""
+
+    def __init__(self, stream=None, encoding=None, chunk_size=65536):
+        """`stream` and `encoding` default to sys.stdout and its
+        encoding"""
+        self.stream = stream or sys.stdout
+        self.encoding = encoding or stdout_encoding
+        self.chunk_size = chunk_size
+        self._pending = []
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def write(self, text):
+        """Writes `text`"""
+        self._pending.append(text)
+        self._size += len(text)
+        if self._size >= self.chunk_size:
+            self._write_pending()
+
+    def writelines(self, lines):
+        """Writes every string in the iterable `lines`. Like
+        file.writelines, it doesn't add line separators."""
+        pending = self._pending
+        for line in lines:
+            pending.append(line)
+            self._size += len(line)
+            if self._size >= self.chunk_size:
+                self._write_pending()
+
+    def _write_pending(self):
+        """Encodes and writes pending text"""
+        if self._pending:
+            text = u''.join(self._pending)
+            del self._pending[:]
+            self._size = 0
+            self.stream.write(text.encode(self.encoding, 'replace'))
+
+    def flush(self):
+        """Writes pending text and flushes the stream"""
+        self._write_pending()
+        self.stream.flush()
+
+
 # preserve old raw_input in this module namespace
 no_encoding_raw_input = raw_input
 no_encoding_exit = sys.exit
@@ -89,12 +169,12 @@ no_encoding_exit = sys.exit
 def raw_input(prompt=None):
     """A raw_input variant, which is encoding aware"""
     if prompt:
-        prompt = prompt.encode(stdout_encoding)
+        prompt = prompt.encode(stdout_encoding, 'replace')
     retval = no_encoding_raw_input(prompt)
     return retval.decode(stdin_encoding)
 
 def exit(status):
     """Works like sys.exit, but is unicode-safe"""
     if isinstance(status, unicode):
-        status = status.encode(stderr_encoding)
+        status = status.encode(stderr_encoding, 'replace')
     no_encoding_exit(status)
@@ -28,11 +28,19 @@ __revision__ = '$Id$'
 
 
 import re
+import heapq
+import itertools
 import UserDict
+import bisect
+import contextlib
+import sre_parse
+import sre_constants
 
 from tel import teltypes
 from tel import backendmanager
 from tel import config
+from tel.query import (Predicate, Equals, Prefix, Regex, And, Or, Sort,
+                       Query)
 
 
 _ = config.translation.ugettext
@@ -73,6 +81,321 @@ class NoSuchField(Exception):
         Exception.__init__(self, _('No such field: %s') % field)
 
 
+class InvalidValue(ValueError):
+    """Raised on read access to a value stored with set_raw, which can't be
+    converted into the type of its field"""
+    def __init__(self, field, message):
+        self.field = field
+        ValueError.__init__(self, message)
+
+
+def _literal_prefix(regex):
+    """Returns the literal text, which every match of the compiled
+    `regex` must start with at the beginning of the string, or None, if
+    there is no such text (e.g. because the pattern is not anchored with
+    ^)"""
+    if regex.flags & re.MULTILINE:
+        # ^ matches after every newline
+        return None
+    try:
+        tokens = list(sre_parse.parse(regex.pattern, regex.flags))
+    except (sre_constants.error, TypeError):
+        return None
+    anchors = ((sre_constants.AT, sre_constants.AT_BEGINNING),
+               (sre_constants.AT, sre_constants.AT_BEGINNING_STRING))
+    if not tokens or tokens[0] not in anchors:
+        return None
+    prefix = []
+    # repeated literals are parsed as MAX_REPEAT or MIN_REPEAT tokens, so
+    # all leading LITERAL tokens must appear in every match
+    for opcode, argument in tokens[1:]:
+        if opcode != sre_constants.LITERAL:
+            break
+        prefix.append(unichr(argument))
+    return u''.join(prefix) or None
+
+
+class FieldIndex(object):
+    """An inverted index over the values of a single field.
+
+    Maps the unicode representation of field values to the entries, which
+    contain them. The case-folded values are additionally kept in a sorted
+    list, which is used to answer prefix queries by bisection."""
+
+    def __init__(self, field):
+        self.field = field
+        self.clear()
+
+    def clear(self):
+        """Removes all entries from this index"""
+        # value -> list of entries
+        self._buckets = {}
+        # case-folded value -> set of values
+        self._folded = {}
+        # sorted list of case-folded values, rebuilt lazily
+        self._sorted = None
+
+    def insert(self, value, entry):
+        """Adds `entry` under `value`"""
+        value = unicode(value)
+        bucket = self._buckets.get(value)
+        if bucket is None:
+            self._buckets[value] = [entry]
+            folded = value.lower()
+            if folded not in self._folded:
+                self._folded[folded] = set()
+                self._sorted = None
+            self._folded[folded].add(value)
+        else:
+            bucket.append(entry)
+
+    def discard(self, value, entry):
+        """Removes `entry` from `value`, if present"""
+        value = unicode(value)
+        bucket = self._buckets.get(value)
+        if bucket is None:
+            return
+        # entries are compared by identity, equal entries may exist
+        for pos, item in enumerate(bucket):
+            if item is entry:
+                del bucket[pos]
+                break
+        if not bucket:
+            del self._buckets[value]
+            folded = value.lower()
+            self._folded[folded].discard(value)
+            if not self._folded[folded]:
+                del self._folded[folded]
+                self._sorted = None
+
+    def lookup(self, value):
+        """Returns a list of all entries, whose field equals `value`"""
+        return list(self._buckets.get(unicode(value), ()))
+
+    def prefix(self, prefix, ignore_case=False):
+        """Returns an iterator over all entries, whose field starts with
+        `prefix`"""
+        if self._sorted is None:
+            self._sorted = sorted(self._folded)
+        folded_prefix = prefix.lower()
+        pos = bisect.bisect_left(self._sorted, folded_prefix)
+        while pos < len(self._sorted):
+            folded = self._sorted[pos]
+            if not folded.startswith(folded_prefix):
+                break
+            for value in self._folded[folded]:
+                if ignore_case or value.startswith(prefix):
+                    for entry in self._buckets[value]:
+                        yield entry
+            pos += 1
+
+
+class NumberIndex(object):
+    """A hash index over the normalized phone numbers of entries.
+
+    Maps the digits-only form of the values of all `fields` (see
+    teltypes.normalize_phone_number) to the entries, which contain them,
+    so that entries can be looked up by a number regardless of its
+    formatting."""
+
+    def __init__(self, fields, country_code=None):
+        self.fields = fields
+        self.country_code = country_code
+        self.clear()
+
+    def clear(self):
+        """Removes all entries from this index"""
+        # normalized number -> list of entries
+        self._buckets = {}
+
+    def key(self, number):
+        """Returns the normalized form of `number`, or None, if it contains
+        no digits"""
+        return (teltypes.normalize_phone_number(unicode(number),
+                                                self.country_code) or None)
+
+    def insert_value(self, value, entry):
+        """Adds `entry` under the phone number `value`"""
+        key = self.key(value)
+        if key is not None:
+            self._buckets.setdefault(key, []).append(entry)
+
+    def discard_value(self, value, entry):
+        """Removes `entry` from the phone number `value`, if present"""
+        key = self.key(value)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return
+        # entries are compared by identity, equal entries may exist
+        for pos, item in enumerate(bucket):
+            if item is entry:
+                del bucket[pos]
+                break
+        if not bucket:
+            del self._buckets[key]
+
+    def insert(self, entry):
+        """Adds `entry` under all its phone numbers"""
+        for field in self.fields:
+            self.insert_value(entry[field], entry)
+
+    def discard(self, entry):
+        """Removes `entry` from all its phone numbers"""
+        for field in self.fields:
+            self.discard_value(entry[field], entry)
+
+    def lookup(self, number):
+        """Returns a list of all entries, which contain `number`. An entry
+        appears once for every field containing the number."""
+        return list(self._buckets.get(self.key(number), ()))
+
+
+class SortIndex(object):
+    """Keeps all entries of a phonebook sorted by a single field.
+
+    Entries are sorted by the same keys as in sort_by_field. Entries with
+    equal keys keep the order, in which they were added to the index."""
+
+    def __init__(self, field, ignore_case=False):
+        self.field = field
+        self.ignore_case = ignore_case
+        self.clear()
+
+    def clear(self):
+        """Removes all entries from this index"""
+        # sorted list of (key, sequence number) tuples
+        self._keys = []
+        # entries in the order of _keys
+        self._entries = []
+        # entry id -> (key, sequence number)
+        self._items = {}
+        # sequence number of the next inserted entry
+        self._sequence = 0
+        # sorted keys given to restore. _keys and _items are built from
+        # these not until they are needed.
+        self._restored_keys = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, entry):
+        """Returns the sort key of `entry`"""
+        value = unicode(entry[self.field])
+        return value.lower() if self.ignore_case else value
+
+    def fill(self, entries):
+        """Replaces the contents of this index with `entries`. This is
+        faster than inserting every single entry."""
+        decorated = [(self.key(entry), seq, entry) for (seq, entry) in
+                     enumerate(entries)]
+        decorated.sort()
+        self._set_sorted([(key, seq) for (key, seq, entry) in decorated],
+                         [entry for (key, seq, entry) in decorated])
+
+    def restore(self, keys, entries):
+        """Replaces the contents of this index with the sorted list of
+        `keys` as returned by keys and the corresponding `entries`.
+
+        Restoring is cheap, the internal structures needed to change the
+        index are built on first use."""
+        self.clear()
+        self._entries = entries
+        self._restored_keys = keys
+        self._sequence = len(keys)
+
+    def _unpack(self):
+        """Builds the internal structures of a restored index"""
+        if self._restored_keys is not None:
+            keys = self._restored_keys
+            self._restored_keys = None
+            self._set_sorted(zip(keys, xrange(len(keys))), self._entries)
+
+    def _set_sorted(self, keys, entries):
+        """Sets the sorted lists of (key, sequence number) tuples and
+        entries"""
+        self._keys = keys
+        self._entries = entries
+        self._items = dict(zip([entry.id for entry in entries], keys))
+        self._sequence = len(keys)
+
+    def keys(self):
+        """Returns the sorted list of keys of all entries"""
+        if self._restored_keys is not None:
+            return self._restored_keys
+        return [key for (key, seq) in self._keys]
+
+    def entry_ids(self):
+        """Returns the ids of all entries in sorted order"""
+        return [entry.id for entry in self._entries]
+
+    def insert(self, entry):
+        """Adds `entry`"""
+        self._unpack()
+        self._insert(entry, (self.key(entry), self._sequence))
+        self._sequence += 1
+
+    def _insert(self, entry, item):
+        pos = bisect.bisect_right(self._keys, item)
+        self._keys.insert(pos, item)
+        self._entries.insert(pos, entry)
+        self._items[entry.id] = item
+
+    def discard(self, entry):
+        """Removes `entry`, if present"""
+        self._unpack()
+        item = self._items.pop(entry.id, None)
+        if item is not None:
+            pos = bisect.bisect_left(self._keys, item)
+            del self._keys[pos]
+            del self._entries[pos]
+
+    def update(self, entry):
+        """Moves `entry` to its new position after its field changed. The
+        order relative to entries with equal keys is kept."""
+        self._unpack()
+        item = self._items.get(entry.id)
+        if item is None:
+            return
+        key = self.key(entry)
+        if key != item[0]:
+            self.discard(entry)
+            self._insert(entry, (key, item[1]))
+
+    def iter_entries(self, descending=False):
+        """Returns an iterator over all entries in sorted order. Like
+        sorted, entries with equal keys keep their order, if `descending`
+        is True."""
+        return self.range(descending=descending)
+
+    def range(self, low=None, high=None, descending=False):
+        """Returns an iterator over all entries, whose key is not less than
+        `low` and less than `high`, in sorted order. If `low` or `high` are
+        None, the range is open on this side."""
+        if low is None and high is None and not descending:
+            return iter(self._entries)
+        self._unpack()
+        if self.ignore_case:
+            low = (low.lower() if low is not None else None)
+            high = (high.lower() if high is not None else None)
+        start = (bisect.bisect_left(self._keys, (low,)) if low is not None
+                 else 0)
+        end = (bisect.bisect_left(self._keys, (high,)) if high is not None
+               else len(self._keys))
+        if not descending:
+            return iter(self._entries[start:end])
+        return self._iter_descending(start, end)
+
+    def _iter_descending(self, start, end):
+        """Yields entries from `end` down to `start`. Runs of equal keys are
+        yielded in ascending order."""
+        while end > start:
+            key = self._keys[end-1][0]
+            run = max(start, bisect.bisect_left(self._keys, (key,)))
+            for entry in self._entries[run:end]:
+                yield entry
+            end = run
+
+
 class Phonebook(object):
     """Base class for all phonebook classes defined by backends.
 
@@ -80,68 +403,502 @@ class Phonebook(object):
     absolutely *not* recommended. Indexes may change when reloading
     phonebooks.
 
-    Access to entries should happen using iterators or the find_all method.
+    Access to entries should happen using iterators, the find_all method
+    or the by_id method. Every entry added to a phonebook gets an id, which
+    is unique in this phonebook. Backends store these ids, so they don't
+    change when reloading phonebooks. Entries are identified by their id,
+    not by equality, so membership tests and removal take constant time.
+
+    To speed up find_all on large phonebooks, inverted indexes can be
+    maintained for single fields with create_index. Indexes are filled on
+    load and kept up to date while entries are added, removed or
+    modified. Likewise create_sort_index maintains entries sorted by a
+    field, which is used by sort_by_field and entries_between. Backends
+    may persist sort indexes. create_number_index maintains a hash index
+    over normalized phone numbers for lookup_number.
+
+    Phonebooks loaded lazily parse their entries on demand while they are
+    iterated. Operations, which need all entries, parse the rest of the
+    phonebook first.
+
+    Phonebooks track changes since the last load or save, so that backends
+    can skip saving unchanged phonebooks or only store added entries.
+    Several saves can be grouped into a single one with batch.
+
+    find_all, sort_by_field and execute pass their query to the backend
+    first (see _execute_query), so that backends can use their own search.
+    If the backend declines, entries are scanned in memory.
     """
 
     # defaults to FIELDS
     # overwrite to change the list of supported fields
     fields = None
 
+    # defaults to Entry
+    # overwrite to change the class of entries created by this phonebook
+    entry_class = None
+
     def __init__(self, uri):
         self.uri = uri
+        # removed entries leave a None in this list until it is compacted
         self._entries = []
-
-    def load(self):
-        """Loads entries from backend"""
+        # entry id -> position of entry in _entries
+        self._positions = {}
+        # number of None items in _entries
+        self._holes = 0
+        # field name -> FieldIndex
+        self._indexes = {}
+        # (field name, ignore case) -> SortIndex
+        self._sort_indexes = {}
+        # keys of sort indexes, which are persisted by the backend
+        self._persistent_sort_indexes = set()
+        # NumberIndex or None
+        self._number_index = None
+        # iterator over entries, which are not yet parsed
+        self._pending = None
+        # True, if entries were changed or removed since the last load or
+        # save
+        self._modified = False
+        # number of entries added since the last load or save. These are
+        # always the last entries.
+        self._added = 0
+        # nesting depth of batch blocks
+        self._batch_depth = 0
+        # True, if save was called in a batch
+        self._save_requested = False
+
+    def load(self, lazy=False, lazy_types=False):
+        """Loads entries from backend.
+
+        If `lazy` is True, backends may defer parsing of entries until they
+        are accessed. If `lazy_types` is True, backends may defer
+        conversion of field values (see Entry.set_raw)."""
         raise NotImplementedError()
 
     def save(self):
-        """Loads entries from backend"""
+        """Saves entries to backend"""
         raise NotImplementedError()
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Returns a context manager, which defers saving. Inside the with
+        block calls to save only take note of the request. The phonebook
+        is saved once, when the outermost block is left, unless the block
+        is left by an exception:
+
+            with phonebook.batch():
+                for entry in entries:
+                    phonebook.add(entry)
+                    phonebook.save()
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._save_requested = False
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth and self._save_requested:
+            self._save_requested = False
+            self.save()
+
+    def _defer_save(self):
+        """Returns True, if saving must be deferred, because a batch is
+        active. Backends call this at the beginning of save."""
+        if self._batch_depth:
+            self._save_requested = True
+            return True
+        return False
+
+    def is_modified(self):
+        """Returns True, if entries were added, changed or removed since
+        the last load or save"""
+        return self._modified or self._added > 0
+
+    def added_entries(self):
+        """Returns a list of all entries added since the last load or
+        save, if no other changes happened in the meantime. Returns None
+        otherwise."""
+        if self._modified:
+            return None
+        return self._entries[len(self._entries)-self._added:]
+
+    def _mark_clean(self):
+        """Forgets all changes. Called by backends after loading or
+        saving."""
+        self._modified = False
+        self._added = 0
+
+    def _load_lazily(self, entries):
+        """Adds the entries from the iterator `entries` not until they are
+        needed. Backends use this to implement lazy loading."""
+        self._pending = iter(entries)
+
+    def _load_next(self):
+        """Adds the next pending entry. Returns False, if there are no
+        pending entries left."""
+        if self._pending is None:
+            return False
+        try:
+            entry = self._pending.next()
+        except StopIteration:
+            self._pending = None
+            return False
+        self._append(entry)
+        return True
+
+    def _materialize(self):
+        """Adds all pending entries"""
+        while self._load_next():
+            pass
+
+    def create_index(self, *fields):
+        """Maintains an inverted index for each of `fields`, which is used
+        by find_all to answer plain string and prefix queries without
+        scanning all entries."""
+        for field in fields:
+            if field not in self.supported_fields():
+                raise NoSuchField(field)
+            if field not in self._indexes:
+                self._materialize()
+                index = FieldIndex(field)
+                for entry in self:
+                    index.insert(entry[field], entry)
+                self._indexes[field] = index
+
+    def drop_index(self, *fields):
+        """Drops the indexes for `fields`"""
+        for field in fields:
+            self._indexes.pop(field, None)
+
+    def create_sort_index(self, field, ignore_case=False,
+                          persistent=False):
+        """Maintains the entries sorted by `field`. sort_by_field and
+        entries_between use this index instead of sorting.
+
+        If `persistent` is True, the backend may store the index along with
+        the phonebook, so that it needn't be sorted again on the next
+        load. Backends, which don't support this, ignore it."""
+        if field not in self.supported_fields():
+            raise NoSuchField(field)
+        key = (field, ignore_case)
+        restored = False
+        if key not in self._sort_indexes:
+            self._materialize()
+            index = SortIndex(field, ignore_case)
+            stored = (self._stored_sort_index(field, ignore_case) if
+                      persistent else None)
+            if stored is not None and len(stored[1]) == len(self._positions):
+                self._compact()
+                try:
+                    positions = map(self._positions.__getitem__, stored[1])
+                except KeyError:
+                    # outdated
+                    pass
+                else:
+                    index.restore(stored[0], map(self._entries.__getitem__,
+                                                 positions))
+                    restored = True
+            if not restored:
+                index.fill(self)
+            self._sort_indexes[key] = index
+        if persistent and key not in self._persistent_sort_indexes:
+            self._persistent_sort_indexes.add(key)
+            if not restored:
+                self._store_sort_indexes()
+
+    def create_number_index(self, country_code=None):
+        """Maintains a hash index over the normalized numbers of all phone
+        number fields, which is used by lookup_number. `country_code` is
+        used to normalize national numbers (see
+        teltypes.normalize_phone_number)."""
+        index = self._number_index
+        if index is None or index.country_code != country_code:
+            self._materialize()
+            index = NumberIndex(phone_number_fields(self.supported_fields()),
+                                country_code)
+            for entry in self:
+                index.insert(entry)
+            self._number_index = index
+
+    def drop_number_index(self):
+        """Drops the index created by create_number_index"""
+        self._number_index = None
+
+    def lookup_number(self, number, country_code=None):
+        """Returns a list of all entries, which contain the phone number
+        `number` in any phone number field. Numbers are compared in their
+        normalized form, so formatting doesn't matter.
+
+        If there is a number index, lookups take constant time and
+        `country_code` is ignored in favour of the country code of the
+        index. Otherwise all entries are scanned."""
+        index = self._number_index
+        if index is None:
+            index = NumberIndex(phone_number_fields(self.supported_fields()),
+                                country_code)
+            key = index.key(number)
+            if key is None:
+                return []
+            return [entry for entry in self if any(
+                index.key(entry[field]) == key for field in index.fields)]
+        return self._unique([index.lookup(number)])
+
+    def drop_sort_index(self, field, ignore_case=False):
+        """Drops the sort index for `field`"""
+        self._sort_indexes.pop((field, ignore_case), None)
+        self._persistent_sort_indexes.discard((field, ignore_case))
+
+    def sort_index(self, field, ignore_case=False):
+        """Returns the SortIndex for `field`, or None, if there is no such
+        index"""
+        return self._sort_indexes.get((field, ignore_case))
+
+    def persistent_sort_indexes(self):
+        """Returns a list of all sort indexes, which should be persisted"""
+        return [self._sort_indexes[key] for key in
+                self._persistent_sort_indexes]
+
+    def _stored_sort_index(self, field, ignore_case):
+        """Returns the persisted sort index for `field` as a tuple of the
+        sorted keys and the entry ids in the same order (see SortIndex.keys
+        and SortIndex.entry_ids), or None, if there is no valid persisted
+        index. Backends, which persist sort indexes, implement this and
+        _store_sort_indexes."""
+        return None
+
+    def _store_sort_indexes(self):
+        """Persists all sort indexes returned by persistent_sort_indexes.
+        Called, when a new persistent sort index was built."""
+        pass
+
+    def execute(self, query):
+        """Returns an iterator over all entries selected by `query`, a
+        tel.query.Query object. The backend gets the chance to answer the
+        query first, otherwise entries are filtered and sorted in
+        memory."""
+        found = self._execute_query(query)
+        if found is not None:
+            return iter(found)
+        entries = (self if query.where is None else
+                   self.ifind_all(query.where))
+        if query.sort is not None:
+            sort = query.sort
+            return iter(sort_by_field(entries, sort.field, sort.descending,
+                                      sort.ignore_case, query.limit))
+        if query.limit is not None:
+            return itertools.islice(entries, query.limit)
+        return iter(entries)
+
+    def _execute_query(self, query):
+        """Returns an iterable over all entries selected by `query`, or
+        None, if the backend can't answer `query`. In the latter case the
+        entries are scanned in memory.
+
+        Backends, which can search entries themselves, implement this. They
+        may decline any query, e.g. if they can't express a predicate or if
+        there are unsaved changes."""
+        return None
+
+    def entries_between(self, field, low=None, high=None,
+                        ignore_case=False, descending=False):
+        """Returns an iterator over all entries, whose `field` is not less
+        than `low` and less than `high`, sorted by `field`. Values are
+        compared like in sort_by_field. If there is no sort index for
+        `field`, entries are filtered and sorted."""
+        index = self.sort_index(field, ignore_case)
+        if index is not None:
+            return index.range(low, high, descending)
+        if ignore_case:
+            low = (low.lower() if low is not None else None)
+            high = (high.lower() if high is not None else None)
+        def in_range(entry):
+            value = unicode(entry[field])
+            if ignore_case:
+                value = value.lower()
+            return ((low is None or value >= low) and
+                    (high is None or value < high))
+        return iter(sort_by_field(self.ifind_all(in_range), field,
+                                  descending, ignore_case))
+
+    def _index_entry(self, entry):
+        """Adds `entry` to all indexes"""
+        for field, index in self._indexes.iteritems():
+            index.insert(entry[field], entry)
+        for index in self._sort_indexes.itervalues():
+            index.insert(entry)
+        if self._number_index is not None:
+            self._number_index.insert(entry)
+
+    def _unindex_entry(self, entry):
+        """Removes `entry` from all indexes"""
+        for field, index in self._indexes.iteritems():
+            index.discard(entry[field], entry)
+        for index in self._sort_indexes.itervalues():
+            index.discard(entry)
+        if self._number_index is not None:
+            self._number_index.discard(entry)
+
+    def _field_changed(self, entry, field, oldvalue):
+        """Called by contained entries, after `field` of `entry` was
+        changed from `oldvalue`"""
+        self._modified = True
+        index = self._indexes.get(field)
+        if index is not None:
+            index.discard(oldvalue, entry)
+            index.insert(entry[field], entry)
+        for ignore_case in (False, True):
+            index = self._sort_indexes.get((field, ignore_case))
+            if index is not None:
+                index.update(entry)
+        index = self._number_index
+        if index is not None and field in index.fields:
+            index.discard_value(oldvalue, entry)
+            index.insert_value(entry[field], entry)
+
+    def _compact(self):
+        """Removes the holes left by removed entries from _entries"""
+        if self._holes:
+            self._entries = [e for e in self._entries if e is not None]
+            self._update_positions()
+
+    def _update_positions(self):
+        """Rebuilds the mapping of entries to their positions"""
+        self._positions = dict((e.id, pos) for (pos, e) in
+                               enumerate(self._entries))
+        self._holes = 0
+
+    def _assign_id(self, entry):
+        """Gives `entry` a new id, if it has none or if its id is already
+        used by another entry"""
+        if entry.id is None or entry.id in self._positions:
+            entry.id = new_entry_id()
+
     def __delitem__(self, index):
+        self._materialize()
+        self._compact()
         if isinstance(index, slice):
-            for entry in self._entries[index]:
-                entry.parent = None
+            removed = self._entries[index]
         else:
-            self._entries[index].parent = None
+            removed = [self._entries[index]]
+        for entry in removed:
+            self._unindex_entry(entry)
+            entry.parent = None
         del self._entries[index]
+        self._update_positions()
+        self._modified = True
 
     def __getitem__(self, index):
+        self._materialize()
+        self._compact()
         return self._entries[index]
 
     def __setitem__(self, index, entry):
+        self._materialize()
+        self._compact()
         if isinstance(index, slice):
-            for e in entry:
-                e.parent = self
+            entry = list(entry)
+            removed, added = self._entries[index], entry
         else:
-            entry.parent = self
+            removed, added = [self._entries[index]], [entry]
+        for e in removed:
+            self._unindex_entry(e)
+            e.parent = None
+        for e in added:
+            e.parent = self
+            self._assign_id(e)
+            self._index_entry(e)
         self._entries[index] = entry
+        self._update_positions()
+        self._modified = True
 
     def __contains__(self, entry):
-        return entry in self._entries
+        # pending entries cannot be known to the caller
+        pos = self._positions.get(entry.id)
+        return pos is not None and self._entries[pos] is entry
+
+    def by_id(self, entry_id):
+        """Returns the entry with the id `entry_id`
+
+        :raises KeyError: If there is no such entry"""
+        pos = self._positions.get(entry_id)
+        if pos is None:
+            # the entry may not be parsed yet
+            self._materialize()
+            pos = self._positions[entry_id]
+        return self._entries[pos]
 
     def __iter__(self):
-        return iter(self._entries)
+        if self._pending is None and not self._holes:
+            return iter(self._entries)
+        return self._iter_lazily()
+
+    def _iter_lazily(self):
+        """Iterates over all entries, skipping holes and parsing pending
+        entries on demand"""
+        pos = 0
+        while pos < len(self._entries) or self._load_next():
+            entry = self._entries[pos]
+            if entry is not None:
+                yield entry
+            pos += 1
 
     def clear(self):
         """Removes all entries"""
         self._entries = []
+        self._positions = {}
+        self._holes = 0
+        self._pending = None
+        self._modified = True
+        for index in self._indexes.itervalues():
+            index.clear()
+        for index in self._sort_indexes.itervalues():
+            index.clear()
+        if self._number_index is not None:
+            self._number_index.clear()
 
     def remove(self, entry):
-        """Removes `entry`"""
-        self._entries.remove(entry)
+        """Removes `entry`
+
+        :raises ValueError: If `entry` is not contained in this
+        phonebook"""
+        if entry not in self:
+            raise ValueError(u'Entry not in phonebook')
+        pos = self._positions.pop(entry.id)
+        self._entries[pos] = None
+        self._holes += 1
+        if self._holes > len(self._entries) // 2:
+            self._compact()
+        self._unindex_entry(entry)
         entry.parent = None
+        self._modified = True
 
     def add(self, entry):
         """Adds `entry`"""
         if entry.parent is not None:
             # copy entry, if it is already contained in a phonebook
-            entry = Entry(entry)
+            entry = self.new_entry(entry)
+        # keep the order of pending entries
+        self._materialize()
+        self._append(entry)
+        self._added += 1
+
+    def _append(self, entry):
+        """Appends `entry` without any further checks"""
         entry.parent = self
+        self._assign_id(entry)
+        self._positions[entry.id] = len(self._entries)
         self._entries.append(entry)
+        self._index_entry(entry)
 
     def find_all(self, pattern, *fields):
+        """Returns a list of all entries matching `pattern`. See ifind_all
+        for a description of arguments."""
+        return list(self.ifind_all(pattern, *fields))
+
+    def ifind_all(self, pattern, *fields):
         """Searchs this phonebook for certain patterns.
         `pattern` may either be
 
@@ -150,28 +907,104 @@ class Phonebook(object):
           `fields`
         - a callable object, which gets an entry object as parameter and
           may return a boolean value indicating, if the entry is matched.
-
-        If the last form of invocation is used, *fields is ignored."""
+          Predicates of tel.query are passed to the backend first.
+
+        If the last form of invocation is used, *fields is ignored.
+
+        This method returns an iterator. Entries of lazily loaded
+        phonebooks are parsed only as far as the iterator is consumed.
+
+        If all `fields` are indexed (see create_index), plain strings and
+        regular expressions anchored with a literal prefix (like
+        "^Smith") are answered from the indexes. Likewise predicates are
+        answered from the indexes, if they contain such comparisons of
+        indexed fields, which narrow the search (e.g. any operand of And,
+        all operands of Or). In this case entries are not returned in
+        phonebook order."""
+        if isinstance(pattern, Predicate):
+            found = self._execute_query(Query(pattern))
+            if found is not None:
+                return iter(found)
+            candidates = None
+            if self._indexes:
+                # indexes only know about parsed entries
+                self._materialize()
+                candidates = self._candidates(pattern)
+            match = pattern.matcher()
+            return (entry for entry in (self if candidates is None else
+                                        candidates) if match(entry))
         if callable(pattern):
-            return [entry for entry in self if pattern(entry)]
+            return (entry for entry in self if pattern(entry))
         # if fields are empty raise ValueError
         if not fields:
             raise ValueError(u'No fields specified')
 
-        entries = []
         if isinstance(pattern, basestring):
             # plain text comparison
             # XXX: perform type-safe comparison
-            for entry in self:
-                if any((unicode(entry[f]) == pattern for f in fields)):
-                    entries.append(entry)
+            return self.ifind_all(Or(*[Equals(f, pattern) for f in fields]))
+        # regular expression search
+        return self.ifind_all(Or(*[Regex(f, pattern) for f in fields]))
+
+    def _candidates(self, predicate):
+        """Looks up the entries, which may be matched by `predicate`, in
+        the field indexes. Returns a list of entries, which contains at
+        least all matching entries, or None, if the indexes can't narrow
+        the search."""
+        if isinstance(predicate, And):
+            # the smallest list of any operand
+            best = None
+            for operand in predicate.operands:
+                candidates = self._candidates(operand)
+                if candidates is not None and \
+                       (best is None or len(candidates) < len(best)):
+                    best = candidates
+            return best
+        if isinstance(predicate, Or):
+            # the union of all operands
+            lists = map(self._candidates, predicate.operands)
+            if None in lists:
+                return None
+            return self._unique(lists)
+        if not isinstance(predicate, (Equals, Prefix, Regex)):
+            return None
+        index = self._indexes.get(predicate.field)
+        if index is None:
+            return None
+        if isinstance(predicate, Equals):
+            if not predicate.ignore_case:
+                return index.lookup(predicate.value)
+            prefix = predicate.value
+        elif isinstance(predicate, Prefix):
+            prefix = predicate.prefix
         else:
-            # regular expression search
-            for entry in self:
-                if any((pattern.search(unicode(entry[f])) for f in fields)):
+            prefix = _literal_prefix(predicate.regex)
+        if prefix is None:
+            return None
+        return list(index.prefix(prefix, predicate.ignore_case))
+
+    @staticmethod
+    def _unique(iterables):
+        """Chains `iterables` into a list of entries, dropping entries,
+        which appear more than once"""
+        seen = set()
+        entries = []
+        for iterable in iterables:
+            for entry in iterable:
+                if id(entry) not in seen:
+                    seen.add(id(entry))
                     entries.append(entry)
         return entries
 
+    @classmethod
+    def new_entry(cls, *args, **kwargs):
+        """Creates a new entry of the class used by this phonebook. All
+        arguments are passed to the constructor of this class.
+
+        Basically it just interprets the entry_class attribute.
+        If this attribute is None, then Entry is used."""
+        return (cls.entry_class or Entry)(*args, **kwargs)
+
     @classmethod
     def supported_fields(cls):
         """Returns a list of all supported fields
@@ -184,25 +1017,175 @@ class Phonebook(object):
         return cls.fields or FIELDS
 
 
-class Entry(object, UserDict.DictMixin):
+class _EntryBase(object):
+    """Mapping interface shared by all entry classes.
+
+    Subclasses must implement keys, __getitem__, __setitem__ and
+    __delitem__. Unlike UserDict.DictMixin this class doesn't give
+    instances a __dict__, so subclasses may use __slots__."""
+
+    __slots__ = ()
+
+    def __unicode__(self):
+        return config.short_entry_format % self
+
+    __str__ = __unicode__
+
+    def __repr__(self):
+        return '%s "%s %s" at %s' % (self.__class__.__name__,
+                                     self['firstname'], self['lastname'],
+                                     id(self))
+
+    def prettify(self):
+        """Returns a pretty representation of this entry"""
+        return config.long_entry_format % self
+
+    def convert(self):
+        """Converts all values stored with set_raw into their field types.
+
+        :raises InvalidValue: If a value is invalid"""
+        if self._raw:
+            for field in FIELDS:
+                self[field]
+
+    def __nonzero__(self):
+        return any((self[field] != '' for field in self))
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __cmp__(self, other):
+        if other is None:
+            return 1
+        if isinstance(other, (_EntryBase, UserDict.DictMixin)):
+            other = dict(other.iteritems())
+        return cmp(dict(self.iteritems()), other)
+
+    def setdefault(self, field, default=None):
+        """Sets field to `value`, if field is empty"""
+        if self[field] == '':
+            self[field] = default
+        return self[field]
+
+    def __contains__(self, field):
+        """Returns True, if `field` contains a non-empty value"""
+        return self[field] != ''
+
+    has_key = __contains__
+
+    def get(self, field, default=None):
+        """Returns the value of `field`, or `default`, if `field` is
+        empty"""
+        value = self[field]
+        return (default if value == '' else value)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        """Returns an iterator over key, value pairs"""
+        return ((field, self[field]) for field in self)
+
+    def itervalues(self):
+        """Returns an iterator over all values"""
+        return (self[field] for field in self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def update(self, other=None, **kwargs):
+        """Sets all fields from the mapping `other` and from keyword
+        arguments"""
+        if other is not None:
+            if hasattr(other, 'iteritems'):
+                other = other.iteritems()
+            for field, value in other:
+                self[field] = value
+        for field in kwargs:
+            self[field] = kwargs[field]
+
+    def clear(self):
+        """Empties all fields"""
+        for field in self:
+            del self[field]
+
+
+def _convert_value(field, value):
+    """Converts `value` into the type of `field`. Empty values are not
+    converted."""
+    ftype = field_type(field)
+    if value != '' and not isinstance(value, ftype):
+        value = ftype(value)
+    return value
+
+
+def _convert_raw(field, value):
+    """Converts `value` stored with set_raw into the type of `field`.
+
+    :raises InvalidValue: If `value` is invalid"""
+    try:
+        return _convert_value(field, value)
+    except ValueError, err:
+        raise InvalidValue(field, unicode(err))
+
+
+# maps field names to their position in FIELDS
+_FIELD_POSITIONS = dict((field, pos) for (pos, field) in enumerate(FIELDS))
+
+
+def _needs_conversion(field, value):
+    """Returns True, if the unicode string `value` must be converted to be
+    stored in `field`"""
+    return value != '' and field_type(field) is not unicode
+
+
+class Entry(_EntryBase, UserDict.DictMixin):
     """This class represents a single entry in a phonebook.
     It supports all fields present in the FIELDS tuple.
 
+    Field values stored with set_raw are converted into the field type
+    not until they are read first.
+
     :ivar parent: The phonebook, which contains this entry, or None, if this
-    entry has not been added to a phonebook"""
+    entry has not been added to a phonebook
+    :ivar id: A string, which identifies this entry in its phonebook, or
+    None, if the entry was never added to a phonebook. Copies don't
+    share the id."""
 
     def __init__(self, entry=None, **kwargs):
         """If `entry` is given, copy all fields from `entry`.
         Any keyword arguments are regarded as field values, and are stored
         if no other value has been given"""
         self.parent = None
+        self.id = None
         self.fields = dict.fromkeys(FIELDS, '')
+        # bit mask of fields with unconverted values
+        self._raw = 0
         if entry:
             # copy constructor
             self.fields.update(entry)
         for k in kwargs:
             self.setdefault(k, kwargs[k])
 
+    @classmethod
+    def from_raw(cls, values, raw):
+        """Creates an entry from the state returned by raw_values"""
+        entry = cls()
+        entry.fields = dict(zip(FIELDS, values))
+        entry._raw = raw
+        return entry
+
+    def raw_values(self):
+        """Returns a tuple of all values ordered like FIELDS and the bit mask
+        of unconverted values. Backends use this to cache entries, which
+        contain only values stored with set_raw."""
+        return (tuple(self.fields[field] for field in FIELDS), self._raw)
+
     def keys(self):
         """Return a list of all keys, which is basically a copy of
         `FIELDS`"""
@@ -211,56 +1194,153 @@ class Entry(object, UserDict.DictMixin):
     def __getitem__(self, field):
         if field not in self.keys():
             raise NoSuchField(field)
+        if self._raw:
+            bit = 1 << _FIELD_POSITIONS[field]
+            if self._raw & bit:
+                # convert on first access
+                self.fields[field] = _convert_raw(field,
+                                                  self.fields[field])
+                self._raw &= ~bit
         return self.fields[field]
 
-    def __unicode__(self):
-        return config.short_entry_format % self
-
-    __str__ = __unicode__
-
-    def __repr__(self):
-        return '%s "%s %s" at %s' % (self.__class__.__name__,
-                                     self['firstname'], self['lastname'],
-                                     id(self))
+    def set_raw(self, field, value):
+        """Stores the unicode string `value` in `field`. `value` is
+        converted and validated not until `field` is read first, so an
+        invalid value raises InvalidValue on read access."""
+        if field not in self.keys():
+            raise KeyError(u'Invalid field %s' % field)
+        if _needs_conversion(field, value):
+            self._set_value(field, value)
+            self._raw |= 1 << _FIELD_POSITIONS[field]
+        else:
+            self._set_value(field, value)
 
-    def prettify(self):
-        """Returns a pretty representation of this entry"""
-        return config.long_entry_format % self
+    def _set_value(self, field, value):
+        """Stores `value` in `field` and notifies the parent"""
+        self._raw &= ~(1 << _FIELD_POSITIONS[field])
+        oldvalue = self.fields[field]
+        self.fields[field] = value
+        if self.parent is not None:
+            self.parent._field_changed(self, field, oldvalue)
 
     def __setitem__(self, field, value):
         if field not in self.keys():
             raise KeyError(u'Invalid field %s' % field)
-        # get the field type
-        ftype = field_type(field)
-        if value != '' and not isinstance(value, ftype):
-            # convert the given value into the field type
-            value = ftype(value)
-        self.fields[field] = value
+        # convert the given value into the field type
+        self._set_value(field, _convert_value(field, value))
 
     def __delitem__(self, field):
         if field not in self.keys():
             raise KeyError(u'Invalid field %s' % field)
-        self.fields[field] = ''
+        self._set_value(field, '')
 
-    def __nonzero__(self):
-        return any((self[field] != '' for field in self))
 
-    def setdefault(self, field, default=None):
-        """Sets field to `value`, if field is empty"""
-        if self[field] == '':
-            self[field] = default
-        return self[field]
+class CompactEntry(_EntryBase):
+    """A memory saving variant of Entry with the same mapping interface.
 
-    def __contains__(self, field):
-        """Returns True, if `field` contains a non-empty value"""
-        return self[field] != ''
+    Field values are stored in a list ordered like FIELDS, and all empty
+    fields refer to the same empty string. CompactEntry has no instance
+    dictionary, so no attributes other than `parent` and `id` may be
+    set.
 
-    def __iter__(self):
-        return iter(self.keys())
+    Field values stored with set_raw are converted into the field type
+    not until they are read first.
 
-    def iteritems(self):
-        """Returns an iterator over key, value pairs"""
-        return ((field, self[field]) for field in self)
+    :ivar parent: The phonebook, which contains this entry, or None, if this
+    entry has not been added to a phonebook
+    :ivar id: A string, which identifies this entry in its phonebook, or
+    None, if the entry was never added to a phonebook. Copies don't
+    share the id."""
+
+    __slots__ = ('parent', 'id', '_values', '_raw')
+
+    def __init__(self, entry=None, **kwargs):
+        """If `entry` is given, copy all fields from `entry`.
+        Any keyword arguments are regarded as field values, and are stored
+        if no other value has been given"""
+        self.parent = None
+        self.id = None
+        self._values = [''] * len(FIELDS)
+        # bit mask of fields with unconverted values
+        self._raw = 0
+        if entry:
+            # copy constructor
+            for field in entry:
+                try:
+                    self._values[_FIELD_POSITIONS[field]] = entry[field]
+                except KeyError:
+                    raise KeyError(u'Invalid field %s' % field)
+        for k in kwargs:
+            self.setdefault(k, kwargs[k])
+
+    @classmethod
+    def from_raw(cls, values, raw):
+        """Creates an entry from the state returned by raw_values"""
+        entry = cls.__new__(cls)
+        entry.parent = None
+        entry.id = None
+        entry._values = list(values)
+        entry._raw = raw
+        return entry
+
+    def raw_values(self):
+        """Returns a tuple of all values ordered like FIELDS and the bit mask
+        of unconverted values. Backends use this to cache entries, which
+        contain only values stored with set_raw."""
+        return (tuple(self._values), self._raw)
+
+    def keys(self):
+        """Return a list of all keys, which is basically a copy of
+        `FIELDS`"""
+        return FIELDS
+
+    def __getitem__(self, field):
+        try:
+            pos = _FIELD_POSITIONS[field]
+        except KeyError:
+            raise NoSuchField(field)
+        if self._raw & (1 << pos):
+            # convert on first access
+            self._values[pos] = _convert_raw(field, self._values[pos])
+            self._raw &= ~(1 << pos)
+        return self._values[pos]
+
+    def set_raw(self, field, value):
+        """Stores the unicode string `value` in `field`. `value` is
+        converted and validated not until `field` is read first, so an
+        invalid value raises InvalidValue on read access."""
+        if field not in _FIELD_POSITIONS:
+            raise KeyError(u'Invalid field %s' % field)
+        if value == '':
+            self._set_value(field, '')
+        elif _needs_conversion(field, value):
+            self._set_value(field, value)
+            self._raw |= 1 << _FIELD_POSITIONS[field]
+        else:
+            self._set_value(field, value)
+
+    def _set_value(self, field, value):
+        """Stores `value` in `field` and notifies the parent"""
+        try:
+            pos = _FIELD_POSITIONS[field]
+        except KeyError:
+            raise KeyError(u'Invalid field %s' % field)
+        self._raw &= ~(1 << pos)
+        oldvalue = self._values[pos]
+        self._values[pos] = value
+        if self.parent is not None:
+            self.parent._field_changed(self, field, oldvalue)
+
+    def __setitem__(self, field, value):
+        if field not in _FIELD_POSITIONS:
+            raise KeyError(u'Invalid field %s' % field)
+        if value == '':
+            # share the empty value
+            value = ''
+        self._set_value(field, _convert_value(field, value))
+
+    def __delitem__(self, field):
+        self._set_value(field, '')
 
 
 class URI(object):
@@ -320,6 +1400,13 @@ class URI(object):
             return self.location
 
 
+def new_entry_id():
+    """Returns a new, globally unique entry id"""
+    # uuid loads ctypes, which is slow, so import it on first use
+    import uuid
+    return unicode(uuid.uuid4().hex)
+
+
 def phonebook_open(uri):
     """Opens a phonebook denoted by `uri`. `uri` may be a plain string, or
     an instance of URI class.
@@ -332,8 +1419,10 @@ def phonebook_open(uri):
     uri.absolutize()
     if uri.scheme is None:
         raise IOError(_(u'Couldn\'t find a backend for %s.') % uri)
+    manager = backendmanager.manager()
     try:
-        backend = backendmanager.manager()[uri.scheme]
+        backend = manager[manager.backend_for_scheme(uri.scheme) or
+                          uri.scheme]
     except KeyError:
         raise IOError(_(u'Unknown backend %s.') % uri.scheme)
     return backend.__phonebook_class__(uri)
@@ -341,12 +1430,38 @@ def phonebook_open(uri):
 
 # shortcut to sort entry iterables by a certain field
 # it's just an easy wrapper around the sorted builtin, no big thing
-def sort_by_field(entries, field, descending=False, ignore_case=False):
-    """Returns a sorted list of entries in this phonebook"""
+def sort_by_field(entries, field, descending=False, ignore_case=False,
+                  limit=None):
+    """Returns a sorted list of entries in this phonebook
+
+    :param limit: If not None, only the first `limit` entries are returned.
+    They are selected with a heap, which is faster than sorting all
+    entries, if `limit` is small.
+
+    If `entries` is a phonebook, its backend may sort the entries (see
+    Phonebook._execute_query). Otherwise the entries are taken from the
+    sort index for `field`, if there is one (see
+    Phonebook.create_sort_index)."""
     def field_getter(entry):
         value = unicode(entry[field])
         return value.lower() if ignore_case else value
-    return sorted(entries, key=field_getter, reverse=descending)
+    index = None
+    if isinstance(entries, Phonebook):
+        found = entries._execute_query(
+            Query(sort=Sort(field, descending, ignore_case), limit=limit))
+        if found is not None:
+            return list(found)
+        index = entries.sort_index(field, ignore_case)
+    if index is not None:
+        ordered = index.iter_entries(descending)
+        if limit is not None:
+            ordered = itertools.islice(ordered, limit)
+        return list(ordered)
+    if limit is None:
+        return sorted(entries, key=field_getter, reverse=descending)
+    # like sorted, these keep the order of entries with equal keys
+    select = (heapq.nlargest if descending else heapq.nsmallest)
+    return select(limit, entries, key=field_getter)
 
 
 # functions to query field information
@@ -359,6 +1474,12 @@ def translate_field(field):
         raise NoSuchField(field)
 
 
+def phone_number_fields(fields=FIELDS):
+    """Returns a list of all `fields` of type phone_number"""
+    return [field for field in fields if
+            field_type(field) is teltypes.phone_number]
+
+
 def field_type(field):
     """Returns the type of `field`
     :raises ValueError: If `field` is not known"""
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+# queries on phonebook entries
+# Copyright (c) 2007 Sebastian Wiesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+"""This module provides queries on phonebook entries.
+
+A query consists of a predicate, which selects entries, an optional sort
+order and an optional limit. Predicates form a small tree of field
+comparisons (Equals, Prefix and Regex) combined with And and Or. Every
+predicate is a callable, which tests a single entry, so queries can always
+be evaluated by scanning all entries. Backends may translate them into
+their own search instead (see Phonebook._execute_query).
+
+parse compiles query strings like "town=Berlin AND tags~work" into
+predicates."""
+
+
+__revision__ = '$Id$'
+
+
+import re
+import datetime
+
+from tel import config, teltypes
+
+
+_ = config.translation.ugettext
+
+
+class QueryError(ValueError):
+    """Raised by parse for invalid queries"""
+
+
+class Predicate(object):
+    """Base class of all predicates. Calling a predicate with an entry
+    returns True, if the entry matches. Predicates are combined with & and
+    |.
+
+    :cvar cost: The relative cost of testing an entry. And and Or test
+    cheap operands first."""
+
+    cost = 1
+
+    def __call__(self, entry):
+        raise NotImplementedError()
+
+    def matcher(self):
+        """Returns a function, which tests a single entry like this
+        predicate, but faster. Use this to test many entries."""
+        return self
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+
+class Equals(Predicate):
+    """Matches entries, whose `field` equals `value`. Values are compared
+    by their unicode representation like in Phonebook.find_all. If `value`
+    is a date, it is compared with the date stored in `field` instead."""
+
+    def __init__(self, field, value, ignore_case=False):
+        self.field = field
+        self.value = value
+        self.ignore_case = ignore_case
+
+    def __call__(self, entry):
+        if isinstance(self.value, datetime.date):
+            return entry[self.field] == self.value
+        value = unicode(entry[self.field])
+        if self.ignore_case:
+            return value.lower() == self.value.lower()
+        return value == self.value
+
+    def __repr__(self):
+        return 'Equals(%r, %r, %r)' % (self.field, self.value,
+                                       self.ignore_case)
+
+
+class Prefix(Predicate):
+    """Matches entries, whose `field` starts with `prefix`"""
+
+    cost = 2
+
+    def __init__(self, field, prefix, ignore_case=False):
+        self.field = field
+        self.prefix = prefix
+        self.ignore_case = ignore_case
+
+    def __call__(self, entry):
+        value = unicode(entry[self.field])
+        if self.ignore_case:
+            return value.lower().startswith(self.prefix.lower())
+        return value.startswith(self.prefix)
+
+    def __repr__(self):
+        return 'Prefix(%r, %r, %r)' % (self.field, self.prefix,
+                                       self.ignore_case)
+
+
+class Regex(Predicate):
+    """Matches entries, whose `field` is matched by the compiled regular
+    expression `regex` (see re.search)"""
+
+    cost = 8
+
+    def __init__(self, field, regex):
+        self.field = field
+        self.regex = regex
+
+    @property
+    def ignore_case(self):
+        """True, if `regex` ignores case"""
+        return bool(self.regex.flags & re.IGNORECASE)
+
+    def __call__(self, entry):
+        return self.regex.search(unicode(entry[self.field])) is not None
+
+    def matcher(self):
+        field, search = self.field, self.regex.search
+        return lambda entry: search(unicode(entry[field])) is not None
+
+    def __repr__(self):
+        return 'Regex(%r, %r)' % (self.field, self.regex.pattern)
+
+
+class And(Predicate):
+    """Matches entries, which are matched by all `operands`"""
+
+    def __init__(self, *operands):
+        self.operands = list(operands)
+
+    @property
+    def cost(self):
+        return sum(operand.cost for operand in self.operands)
+
+    def __call__(self, entry):
+        for operand in self.operands:
+            if not operand(entry):
+                return False
+        return True
+
+    def matcher(self):
+        matchers = [operand.matcher() for operand in
+                    sorted(self.operands, key=_cost)]
+        return lambda entry: all(match(entry) for match in matchers)
+
+    def __repr__(self):
+        return 'And(%s)' % ', '.join(map(repr, self.operands))
+
+
+class Or(Predicate):
+    """Matches entries, which are matched by any of `operands`"""
+
+    def __init__(self, *operands):
+        self.operands = list(operands)
+
+    @property
+    def cost(self):
+        return sum(operand.cost for operand in self.operands)
+
+    def __call__(self, entry):
+        for operand in self.operands:
+            if operand(entry):
+                return True
+        return False
+
+    def matcher(self):
+        regexes = set(operand.regex for operand in self.operands if
+                      isinstance(operand, Regex))
+        if len(regexes) == 1 and all(isinstance(operand, Regex) for operand
+                                     in self.operands):
+            # one expression searched in several fields, as created by
+            # find_all
+            search = regexes.pop().search
+            fields = [operand.field for operand in self.operands]
+            return lambda entry: any(search(unicode(entry[field])) for
+                                     field in fields)
+        matchers = [operand.matcher() for operand in
+                    sorted(self.operands, key=_cost)]
+        return lambda entry: any(match(entry) for match in matchers)
+
+    def __repr__(self):
+        return 'Or(%s)' % ', '.join(map(repr, self.operands))
+
+
+def _cost(predicate):
+    return predicate.cost
+
+
+class Sort(object):
+    """Sorts entries by `field` like sort_by_field"""
+
+    def __init__(self, field, descending=False, ignore_case=False):
+        self.field = field
+        self.descending = descending
+        self.ignore_case = ignore_case
+
+    def __repr__(self):
+        return 'Sort(%r, %r, %r)' % (self.field, self.descending,
+                                     self.ignore_case)
+
+
+class Query(object):
+    """Selects entries matched by the predicate `where` or all entries, if
+    `where` is None. If `sort` is a Sort object, entries are sorted, if
+    `limit` is not None, only the first `limit` entries are selected."""
+
+    def __init__(self, where=None, sort=None, limit=None):
+        self.where = where
+        self.sort = sort
+        self.limit = limit
+
+    def __repr__(self):
+        return 'Query(%r, %r, %r)' % (self.where, self.sort, self.limit)
+
+
+# operators of query terms and the predicates they create
+TERM_OPERATORS = {'=': Equals, '^=': Prefix, '~': Regex}
+# keywords combining terms
+AND, OR = 'AND', 'OR'
+
+# a parenthesis or a word, which may contain quoted text with spaces
+_TOKEN_PATTERN = re.compile(r'''\s*(?:(?P<paren>[()])|
+                            (?P<word>(?:[^\s()"]|"(?:[^"\\]|\\.)*")+))''',
+                            re.UNICODE | re.VERBOSE)
+_TERM_PATTERN = re.compile(r'^(?P<field>\w+)(?P<operator>\^=|=|~)'
+                           r'(?P<value>.*)$', re.UNICODE | re.DOTALL)
+_QUOTED_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+
+def _tokenize(text):
+    """Splits `text` into a list of parentheses and words"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN_PATTERN.match(text, pos)
+        if not match:
+            raise QueryError(_(u'Unterminated quote in query: %s') %
+                             text[pos:].strip())
+        tokens.append(match.group('paren') or match.group('word'))
+        pos = match.end()
+    return tokens
+
+
+def _unquote(text):
+    """Removes the quotes from quoted parts of `text`. Inside quotes \\"
+    stands for " and \\\\ for \\, other backslashes are kept for regular
+    expressions."""
+    return _QUOTED_PATTERN.sub(
+        lambda match: re.sub(r'\\(["\\])', r'\1', match.group(1)), text)
+
+
+def _equals(field, value, ignore_case=False):
+    """Returns an Equals predicate for `field` and the string `value`.
+    Values of date fields in ISO 8601 format are compared as dates, other
+    values by the representation of the field value.
+
+    :raises QueryError: If `field` is unknown or `value` is no valid
+    date"""
+    # phonebook imports this module
+    from tel.phonebook import field_type, NoSuchField
+    try:
+        date_field = (field_type(field) is teltypes.date)
+    except NoSuchField:
+        raise QueryError(_(u'There is no field %s.') % field)
+    if not date_field or not teltypes.date.iso_pattern.match(value):
+        return Equals(field, value, ignore_case)
+    try:
+        return Equals(field, teltypes.date(value))
+    except ValueError, err:
+        raise QueryError(_(u'Invalid date %(value)s: %(message)s') %
+                         {'value': value, 'message': unicode(err)})
+
+
+def _combine(cls, operands):
+    """Combines `operands` with the And or Or class `cls`. Nested
+    predicates of the same class are flattened."""
+    if len(operands) == 1:
+        return operands[0]
+    flat = []
+    for operand in operands:
+        if isinstance(operand, cls):
+            flat.extend(operand.operands)
+        else:
+            flat.append(operand)
+    return cls(*flat)
+
+
+class _Parser(object):
+    """Parses a list of tokens into a predicate"""
+
+    def __init__(self, tokens, fields, search_fields, ignore_case):
+        self.tokens = tokens
+        self.pos = 0
+        self.fields = fields
+        self.search_fields = search_fields
+        self.ignore_case = ignore_case
+        self.flags = re.UNICODE
+        if ignore_case:
+            self.flags |= re.IGNORECASE
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        predicate = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError(_(u'Unexpected "%s" in query') % self.peek())
+        return predicate
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == OR:
+            self.next()
+            operands.append(self.parse_and())
+        return _combine(Or, operands)
+
+    def parse_and(self):
+        # terms without operator are combined with AND
+        operands = [self.parse_atom()]
+        while self.peek() not in (None, ')', OR):
+            if self.peek() == AND:
+                self.next()
+            operands.append(self.parse_atom())
+        return _combine(And, operands)
+
+    def parse_atom(self):
+        token = self.next()
+        if token is None:
+            raise QueryError(_(u'Unexpected end of query'))
+        if token == '(':
+            predicate = self.parse_or()
+            if self.next() != ')':
+                raise QueryError(_(u'Missing ")" in query'))
+            return predicate
+        if token in (')', AND, OR):
+            raise QueryError(_(u'Unexpected "%s" in query') % token)
+        return self.parse_term(token)
+
+    def parse_term(self, token):
+        match = _TERM_PATTERN.match(token)
+        if match is None:
+            # a plain regular expression searched in all search fields
+            regex = self.compile(_unquote(token))
+            return _combine(Or, [Regex(field, regex) for field in
+                                 self.search_fields])
+        field = match.group('field')
+        if field not in self.fields:
+            raise QueryError(_(u'There is no field %s.') % field)
+        value = _unquote(match.group('value'))
+        cls = TERM_OPERATORS[match.group('operator')]
+        if cls is Regex:
+            return Regex(field, self.compile(value))
+        if cls is Equals:
+            return _equals(field, value, self.ignore_case)
+        return cls(field, value, self.ignore_case)
+
+    def compile(self, pattern):
+        try:
+            return re.compile(pattern, self.flags)
+        except re.error, err:
+            msg = _(u'Search pattern "%(pattern)s" invalid: %(message)s')
+            raise QueryError(msg % {'pattern': pattern,
+                                    'message': unicode(err)})
+
+
+def parse(text, fields, search_fields=None, ignore_case=False):
+    """Compiles the query string `text` into a predicate.
+
+    A query consists of terms combined with AND and OR. AND binds
+    stronger, terms without operator in between are combined with AND, and
+    parentheses group terms. A term is one of
+
+    - field=value: `field` equals value
+    - field^=value: `field` starts with value
+    - field~regex: `field` is matched by the regular expression
+    - regex: any of `search_fields` is matched by the regular expression
+
+    Values containing spaces or parentheses are quoted with ". The
+    predicates of And and Or are evaluated from cheap to expensive, so exact
+    comparisons are tested before regular expressions.
+
+    :param fields: The valid field names
+    :param search_fields: The fields searched by terms without field. Defaults
+    to `fields`.
+    :param ignore_case: If True, all terms ignore case
+    :raises QueryError: If `text` is no valid query"""
+    tokens = _tokenize(text)
+    if not tokens:
+        raise QueryError(_(u'Empty query'))
+    parser = _Parser(tokens, fields, search_fields or fields, ignore_case)
+    return parser.parse()
+
+
+def to_data(query):
+    """Converts `query` into nested lists, dictionaries and plain values,
+    which can be serialized as JSON. from_data restores the query."""
+    sort = query.sort
+    if sort is not None:
+        sort = [sort.field, sort.descending, sort.ignore_case]
+    where = (_predicate_to_data(query.where) if query.where is not None
+             else None)
+    return {'where': where, 'sort': sort, 'limit': query.limit}
+
+
+def _predicate_to_data(predicate):
+    if isinstance(predicate, (And, Or)):
+        name = ('and' if isinstance(predicate, And) else 'or')
+        return [name] + map(_predicate_to_data, predicate.operands)
+    if isinstance(predicate, Regex):
+        return ['~', predicate.field, predicate.regex.pattern,
+                predicate.regex.flags]
+    if isinstance(predicate, Equals):
+        value = predicate.value
+        if isinstance(value, datetime.date):
+            value = value.isoformat()
+        return ['=', predicate.field, value, predicate.ignore_case]
+    if isinstance(predicate, Prefix):
+        return ['^=', predicate.field, predicate.prefix,
+                predicate.ignore_case]
+    raise TypeError('Cannot convert %r' % predicate)
+
+
+def from_data(data):
+    """Restores a query converted by to_data
+
+    :raises QueryError: If `data` is invalid"""
+    try:
+        sort = data['sort']
+        if sort is not None:
+            sort = Sort(*sort)
+        where = data['where']
+        if where is not None:
+            where = _predicate_from_data(where)
+        return Query(where, sort, data['limit'])
+    except (TypeError, KeyError, ValueError, re.error), err:
+        raise QueryError(_(u'Invalid query: %s') % err)
+
+
+def _predicate_from_data(data):
+    name = data[0]
+    if name in ('and', 'or'):
+        operands = map(_predicate_from_data, data[1:])
+        return (And if name == 'and' else Or)(*operands)
+    if name == '~':
+        field, pattern, flags = data[1:]
+        return Regex(field, re.compile(pattern, flags))
+    if name == '=':
+        return _equals(*data[1:])
+    return TERM_OPERATORS[name](*data[1:])
@@ -30,8 +30,6 @@ __revision__ = '$Id$'
 import re
 import datetime
 
-import dateutil.parser
-
 
 class email(unicode):
     """Represents a mail address.
@@ -53,6 +51,37 @@ class email(unicode):
                                  % self)
 
 
+# prefix of national numbers, which is dropped in international format
+TRUNK_PREFIX = u'0'
+# prefix dialed before the country code instead of +
+INTERNATIONAL_PREFIX = u'00'
+# the trunk prefix written in international numbers like +49 (0)30 1234
+_OPTIONAL_TRUNK_PATTERN = re.compile(r'\(\s*0\s*\)')
+_NON_DIGIT_PATTERN = re.compile(r'[^0-9]')
+
+
+def normalize_phone_number(number, country_code=None):
+    """Returns the canonical digits-only form of the phone number string
+    `number`, which is used to compare numbers regardless of formatting.
+
+    International numbers lose the leading + or 00. If `country_code` (a
+    string of digits like "49") is given, national numbers with a trunk
+    prefix get this country code instead of the prefix. So with country code
+    49, "+49 (0)30 123-45", "0049 30 12345" and "(030) 123-45" are all
+    normalized to "493012345". Without country code only international
+    numbers are converted."""
+    number = number.strip()
+    if number.startswith(u'+'):
+        number = _OPTIONAL_TRUNK_PATTERN.sub(u'', number)
+        return _NON_DIGIT_PATTERN.sub(u'', number)
+    digits = _NON_DIGIT_PATTERN.sub(u'', number)
+    if digits.startswith(INTERNATIONAL_PREFIX):
+        return digits[len(INTERNATIONAL_PREFIX):]
+    if country_code and digits.startswith(TRUNK_PREFIX):
+        return country_code + digits[len(TRUNK_PREFIX):]
+    return digits
+
+
 class phone_number(unicode):
     """Represents a phone number.
 
@@ -66,16 +95,36 @@ class phone_number(unicode):
             raise ValueError('Invalid literal for phone number: %s'
                              % self)
 
+    def normalized(self, country_code=None):
+        """Returns the canonical digits-only form of this number (see
+        normalize_phone_number)"""
+        return normalize_phone_number(self, country_code)
+
 class date(datetime.date):
-    """Represents a date"""
+    """Represents a date
+
+    :ivar iso_pattern: regular expression matching dates in ISO 8601
+    format as written by isoformat"""
+    # backends store dates in this format, so parse it without dateutil
+    iso_pattern = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+
     def __new__(cls, *args):
         """Creates a new instance. It takes the same arguments as
         datetime.date, or a single argument of either a string type (in
-        which case dateutil.parser.parse is used to extract the date values)
-        or a datetime instance, in which case the values are copied."""
+        which case dateutil.parser.parse is used to extract the date values,
+        unless the string is in ISO 8601 format) or a datetime instance, in
+        which case the values are copied."""
         if len(args) == 1:
             value = args[0]
             if isinstance(value, basestring):
+                match = cls.iso_pattern.match(value)
+                if match:
+                    year, month, day = match.groups()
+                    return datetime.date.__new__(cls, int(year), int(month),
+                                                 int(day))
+                # dateutil is slow to import, so it is only loaded for
+                # other formats
+                import dateutil.parser
                 value = dateutil.parser.parse(value)
             return datetime.date.__new__(cls, value.year, value.month,
                                          value.day)